@@ -0,0 +1,132 @@
+from urllib.parse import urlencode
+from datetime import datetime, timedelta
+import hashlib
+import gzip
+import os
+import threading
+
+"""
+    Content-addressed on-disk cache of raw OAI responses.
+    Responses are keyed by URL and query parameters and stored gzipped under CACHE_DIR.
+    In 'record' mode, responses fetched from the network are written to the cache.
+    In 'replay' mode, responses are only read from the cache and no network requests are made,
+    so mapping changes can be tested against a whole institution without re-harvesting it.
+"""
+
+CACHE_DIR = './files/cache'
+# Verbs whose responses are cached
+CACHED_VERBS = ['ListRecords', 'Identify', 'ListMetadataFormats', 'ListSets']
+MAX_SIZE_MB = 2048
+MAX_AGE_DAYS = 30
+MODE = None
+
+evict_lock = threading.Lock()
+
+
+def configure(mode=None, max_size_mb=None, max_age_days=None):
+    """
+    :param mode: None, 'record' or 'replay'
+    :param max_size_mb: cache size above which the oldest responses are evicted
+    :param max_age_days: age after which responses are evicted
+    """
+    global MODE, MAX_SIZE_MB, MAX_AGE_DAYS
+    MODE = mode
+    if max_size_mb:
+        MAX_SIZE_MB = max_size_mb
+    if max_age_days:
+        MAX_AGE_DAYS = max_age_days
+
+
+class CachedResponse:
+    """
+    Stands in for a requests Response when a page is served from the cache
+    """
+    def __init__(self, url, content):
+        self.url = url
+        self.content = content
+        self.status_code = 200
+        self.headers = {}
+
+
+class CacheMissException(Exception):
+    def __init__(self, url, params):
+        self.message = 'No cached response for request'
+        self.url = url
+        self.params = params
+
+
+def get_key(url, params):
+    query = urlencode(sorted((params or {}).items()), doseq=True)
+    return hashlib.sha256(f"{url}?{query}".encode("utf-8")).hexdigest()
+
+
+def get_path(key):
+    return f"{CACHE_DIR}/{key[:2]}/{key}.gz"
+
+
+def is_cacheable(params):
+    return (params or {}).get('verb') in CACHED_VERBS
+
+
+def get(url, params):
+    """
+    Returns a cached response body
+
+    :param url: request URL
+    :param params: request query parameters
+    :return: response body as bytes, or None if it isn't cached
+    """
+    path = get_path(get_key(url, params))
+    if not os.path.exists(path):
+        return None
+    with gzip.open(path, "rb") as inf:
+        return inf.read()
+
+
+def put(url, params, content):
+    """
+    Stores a response body. Written to a temporary file first so concurrent readers never see a partial file.
+
+    :param url: request URL
+    :param params: request query parameters
+    :param content: response body as bytes
+    """
+    path = get_path(get_key(url, params))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with gzip.open(tmp_path, "wb", compresslevel=6) as outf:
+        outf.write(content)
+    os.replace(tmp_path, path)
+
+
+def evict():
+    """
+    Removes responses older than MAX_AGE_DAYS, then the oldest responses until the cache is under MAX_SIZE_MB
+
+    :return: number of responses removed
+    """
+    if not os.path.isdir(CACHE_DIR):
+        return 0
+    with evict_lock:
+        oldest_allowed = (datetime.now() - timedelta(days=MAX_AGE_DAYS)).timestamp()
+        entries = []
+        removed = 0
+        for root, dirs, files in os.walk(CACHE_DIR):
+            for fn in files:
+                path = os.path.join(root, fn)
+                stat = os.stat(path)
+                if stat.st_mtime < oldest_allowed:
+                    os.remove(path)
+                    removed += 1
+                else:
+                    entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= MAX_SIZE_MB * 1024 * 1024:
+                break
+            os.remove(path)
+            total -= size
+            removed += 1
+
+    return removed
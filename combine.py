@@ -1,15 +1,18 @@
 from glob import glob
-import json
+import argparse
+import ingest
+import utils
 
 def get_data():
-    return glob('./*_data/*.json')
+    # Crawls are saved either as <id>.json or as <id>.jsonl with a summary file, either of them maybe compressed
+    files = glob('./*_data/*.json') + glob('./*_data/*.jsonl') + glob('./*_data/*.json.*') + glob('./*_data/*.jsonl.*')
+    return [file for file in files if ingest.is_data_file(file)]
 
-def write_report():
+def write_report(collisions=None):
     data_files = get_data()
     with open("report.txt", "w") as outf:
         for file in data_files:
-            with open(file, 'r') as inf:
-                data = json.load(inf)
+            data = utils.read_summary(file)
             skipped = data['skipped']
             count = data['count']
             name = data['institution']
@@ -18,33 +21,37 @@ def write_report():
             outf.write(f"   - {skipped} records skipped\n\n")
             # for reason, records in data['skipped_errors'].items():
             #     outf.write(f"       - {reason}: {count(records)}\n\n")
-            inf.close()
+        if collisions:
+            outf.write("# Duplicate @ids left out of the ingest file\n")
+            for line in ingest.get_collision_lines(collisions):
+                outf.write(f"   - {line}\n")
 
-def compile():
+def compile(compression=None, part_size=None, upload=False, previous_hashes=None):
     data_files = get_data()
     if len(data_files) < 1:
         raise Exception("No files found to compile!")
     print("Compiling...")
-    out = []
-    for file in data_files:
-        print(file)
-        with open(file, "r") as inf:
-            data = json.load(inf)
-        out.extend(data['records'])
-        inf.close()
     outfn = "mohub_ingest.json"
     outfn_l = f"{outfn}l"
     # with open(outfn, "w") as outf:
     #     json.dump(out, outf, indent=4)
-    # finish by writing to jsonl, as DPLA prefers
-    with open(outfn_l, "w") as outf:
-        for line in out:
-            json.dump(line, outf)
-            outf.write('\n')
-    write_report()
-    print("Total: {}".format(len(out)))
-    print("Wrote ingest file to {}".format(outfn))
+    # Records are streamed from each file to jsonl, as DPLA prefers, one at a time
+    manifest, collisions = ingest.compile(data_files, outfn_l, compression=compression, part_size=part_size,
+                                          upload=utils.start_upload if upload else None, previous_hashes=previous_hashes)
+    write_report(collisions)
+    print("Total: {}".format(manifest['count']))
+    print("Wrote ingest file to {}".format(", ".join(part['path'] for part in manifest['parts'])))
 
 
-compile()
+parser = argparse.ArgumentParser(description='Compile crawled data files into the DPLA ingest file')
+parser.add_argument('--compression', '-cz', choices=list(ingest.COMPRESSIONS.keys()), default=None,
+                    help="Compresses the ingest file with gzip or zstd (zstd needs the zstandard package).")
+parser.add_argument('--part_mb', '-pm', type=int, default=None,
+                    help="If set, the ingest file is split into numbered part files of about this many MB each.")
+parser.add_argument('--upload', '-u', default=False, action="store_true",
+                    help="If set, the ingest file and its manifest are uploaded to S3 while they're written, see upload_s3.py.")
+parser.add_argument('--previous_hashes', '-ph', default=None,
+                    help="Hashes file of the previous delivery (mohub_ingest.hashes.tsv). If set, the records added, changed and deleted since then are written next to the ingest file.")
+args = parser.parse_args()
+compile(args.compression, args.part_mb * 1024 * 1024 if args.part_mb else None, args.upload, args.previous_hashes)
 
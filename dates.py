@@ -0,0 +1,150 @@
+from dateutil import parser
+from datetime import datetime
+from functools import lru_cache
+import re
+
+"""
+    Date normalisation for record dates. The shapes that make up nearly all values in our feeds are matched with
+    precompiled patterns, and only the rest are handed to dateutil. Results are memoised, since the same values
+    repeat across the records of a feed.
+
+    parse_date_range returns ISO 8601 begin and end dates at the precision of the value:
+    - "1900" -> ("1900", "1900")
+    - "1900-05-01" -> ("1900-05-01", "1900-05-01")
+    - "circa 1900", "ca. 1900", "[1900?]" -> ("1900", "1900")
+    - "1890s" -> ("1890", "1899")
+    - "1900-1910", "1900 to 1910", "1900/1910" -> ("1900", "1910")
+"""
+
+# Number of distinct date values whose results are kept in memory
+DATE_CACHE_SIZE = 16384
+
+DATE_PATTERN = re.compile(r"^(\d{4})(?:-(\d{1,2})(?:-(\d{1,2}))?)?$")
+CIRCA_PATTERN = re.compile(r"^(?:circa|ca\.?|c\.?|approximately|approx\.?|about)\s*(\d{4})$", re.IGNORECASE)
+DECADE_PATTERN = re.compile(r"^(\d{3})0'?s$")
+RANGE_SEPARATOR_PATTERN = re.compile(r"\s*(?:-|–|/|\bto\b)\s*", re.IGNORECASE)
+# Brackets, question marks and trailing periods that catalogers add around otherwise plain dates
+DECORATION_PATTERN = re.compile(r"^[\[(]?(.*?)\??[\])]?\.?$")
+
+
+def match_date(value):
+    """
+    Matches a single date (not a range) against the common patterns
+
+    :param value: date string, already stripped
+    :return: begin and end dates, or None if the value doesn't match
+    """
+    match = DATE_PATTERN.match(value)
+    if match:
+        year, month, day = match.groups()
+        try:
+            datetime(int(year), int(month or 1), int(day or 1))
+        except ValueError:
+            return None
+        if day:
+            date = f"{year}-{int(month):02d}-{int(day):02d}"
+        elif month:
+            date = f"{year}-{int(month):02d}"
+        else:
+            date = year
+        return date, date
+
+    match = CIRCA_PATTERN.match(value)
+    if match:
+        return match.group(1), match.group(1)
+
+    match = DECADE_PATTERN.match(value)
+    if match:
+        return f"{match.group(1)}0", f"{match.group(1)}9"
+
+    return None
+
+
+def match_range(value):
+    """
+    Matches a range of two dates that each match a common pattern, e.g. 1900-1910 or 1900-01-01/1910
+
+    :param value: date string, already stripped
+    :return: begin date of the first date and end date of the second, or None if the value isn't such a range
+    """
+    for separator in RANGE_SEPARATOR_PATTERN.finditer(value):
+        first = match_date(value[:separator.start()])
+        if not first:
+            continue
+        second = match_date(value[separator.end():])
+        if second:
+            return first[0], second[1]
+    return None
+
+
+def parse_with_dateutil(value):
+    """
+    Parses any other date dateutil understands, at the precision given in the value.
+    The value is parsed with two different defaults, so parts that only come from the defaults can be told apart.
+
+    :param value: date string
+    :return: begin and end dates, or None if the value can't be parsed or has no year
+    """
+    try:
+        first = parser.parse(value, default=datetime(1, 1, 1))
+        second = parser.parse(value, default=datetime(2, 2, 2))
+    except (ValueError, OverflowError):
+        return None
+    if first.year != second.year:
+        return None
+    if first.month != second.month:
+        date = f"{first.year:04d}"
+    elif first.day != second.day:
+        date = f"{first.year:04d}-{first.month:02d}"
+    else:
+        date = first.strftime("%Y-%m-%d")
+    return date, date
+
+
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+def parse_date_range(value):
+    """
+    Works out the begin and end dates of a date value
+
+    :param value: date string from a record
+    :return: begin and end dates as ISO 8601 strings, or None for both if the value isn't recognised as a date
+    """
+    if not value or not value.strip():
+        return None, None
+    value = DECORATION_PATTERN.match(value.strip()).group(1).strip()
+    return match_date(value) or match_range(value) or parse_with_dateutil(value) or (None, None)
+
+
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+def parse_datetime(value):
+    """
+    Parses a date string into a datetime, with dateutil's defaults for missing parts
+
+    :param value: date string
+    :return: datetime, or None if the value can't be parsed
+    """
+    match = DATE_PATTERN.match(value)
+    if match and match.group(3):
+        try:
+            return datetime(int(match.group(1)), int(match.group(2)), int(match.group(3)))
+        except ValueError:
+            pass
+    try:
+        return parser.parse(value)
+    except ValueError:
+        return None
+
+
+def get_temporal(display_date):
+    """
+    Builds a sourceResource temporal entry, with begin and end dates when the display date is recognised
+
+    :param display_date: date string from a record
+    :return: dict with displayDate, and begin and end if they could be worked out
+    """
+    temporal = {"displayDate": display_date}
+    begin, end = parse_date_range(display_date)
+    if begin:
+        temporal["begin"] = begin
+        temporal["end"] = end
+    return temporal
@@ -1,6 +1,6 @@
 from bs4 import BeautifulSoup
 import json
-import requests
+import session
 import sys
 
 global_list = []
@@ -8,7 +8,7 @@ global_list = []
 class DPLA():
 
     def get_metadata(self,  url):
-        res = requests.get(url)
+        res = session.get(url)
         return res.json(), res.status_code
 
     def get_original_record(self, record):
@@ -40,7 +40,7 @@ class DPLA():
 
     def get_institutions(partner):
         url = 'https://dp.la/search?partner="{}"'.format(partner)
-        res = requests.get(url)
+        res = session.get(url)
         soup = BeautifulSoup(res.content, 'html.parser')
         script = soup.find('script', {'id': '__NEXT_DATA__'})
 
@@ -0,0 +1,818 @@
+from collections import Counter
+from contextlib import contextmanager
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import zipfile
+
+"""
+    Streaming readers for crawl output, used to compile the combined ingest file. Records are read one at a time,
+    straight out of output files or out of the members of zipped crawl artifacts, and written out as JSONL a line
+    at a time, so compiling takes the same memory however large the hub's metadata is and nothing is extracted to disk.
+
+    - JSON output files ({"institution": ..., "records": [...]}, as written by utils.write_file) are read with
+      JSONReader, which decodes one value at a time from a buffer refilled from the file.
+    - JSONL output files (as written by utils.JSONLWriter) are read a line at a time.
+
+    Either can be gzip or zstd compressed, which is detected from the file's first bytes rather than its name.
+    The ingest file can be compressed too, and split into numbered part files listed in a manifest with their
+    record counts and SHA-256 checksums, see PartWriter.
+
+    Each compile also writes a hashes file, listing every record's @id and a hash of its content in @id order. Given
+    the previous delivery's hashes file, the records added, changed and deleted since then are written next to the
+    ingest file, so a delivery can be checked for churn, or sent as a delta. See write_delta.
+
+    While compiling, every record's @id is checked against IdIndex, an on-disk index of the @ids written so far,
+    so records that more than one institution (or set) produced are only written once, and the institutions that
+    collided are reported.
+"""
+
+# Number of characters read from a JSON file at a time. Values bigger than this grow the buffer as needed.
+CHUNK_SIZE = 1024 * 1024
+# Suffix of the summary file written next to a streamed {id}.jsonl output file
+SUMMARY_SUFFIX = '.summary.json'
+
+# File name suffix of each compression output files can be written with
+COMPRESSIONS = {"gzip": ".gz", "zstd": ".zst"}
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+# Compression levels, chosen for speed over size. gzip's default of 9 is several times slower than 6 for a few % less.
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+# Suffix of the manifest written next to the ingest file, e.g. mohub_ingest.manifest.json
+MANIFEST_SUFFIX = '.manifest.json'
+
+# Size in bits of the Bloom filter in front of the @id index. 64 Mbit (8 MiB) keeps false positives, which cost
+# a look-up in the index, under 1% up to about 5 million @ids.
+BLOOM_BITS = 1 << 26
+# Number of new @ids held in memory before they're written to the index
+INDEX_BATCH_SIZE = 10000
+
+WHITESPACE_PATTERN = re.compile(r"[ \t\n\r]*")
+# Characters that can follow a complete number
+DELIMITERS = ",]} \t\n\r"
+decoder = json.JSONDecoder()
+# Encodes records for hashing, with their keys sorted so that the hash doesn't depend on their order
+hash_encoder = json.JSONEncoder(sort_keys=True, separators=(",", ":"))
+
+
+class JSONReader:
+    """
+    Incremental reader for a JSON document in a text stream. Containers are walked a token at a time and the values
+    in them decoded one by one, and the part of the buffer that has been read is dropped when it's refilled.
+    """
+    __slots__ = ('stream', 'buffer', 'pos', 'eof')
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.buffer: str = ""
+        self.pos: int = 0
+        self.eof: bool = False
+
+    def fill(self):
+        """
+        Reads more of the stream into the buffer, at least as much as is left unread so that big values take
+        a number of reads logarithmic in their size
+
+        :return: False if the stream has been read to the end
+        """
+        if self.eof:
+            return False
+        chunk = self.stream.read(max(CHUNK_SIZE, len(self.buffer) - self.pos))
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """
+        Skips whitespace
+
+        :return: the next character, or "" at the end of the stream
+        """
+        while True:
+            self.pos = WHITESPACE_PATTERN.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return ""
+
+    def take(self, expected):
+        """
+        Reads the next character, which must be one of expected
+        """
+        char = self.peek()
+        if not char or char not in expected:
+            raise json.JSONDecodeError(f"Expected one of {expected!r}", self.buffer, self.pos)
+        self.pos += 1
+        return char
+
+    def value(self):
+        """
+        Decodes the next value
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                # The value may carry on past the end of the buffer
+                if self.fill():
+                    continue
+                raise
+            # So may a number, which decodes without error if it's cut short
+            cut_short = end == len(self.buffer) or type(value) in (int, float) and self.buffer[end] not in DELIMITERS
+            if cut_short and self.fill():
+                continue
+            self.pos = end
+            return value
+
+    def iter_array(self):
+        """
+        Yields the values of the array that starts at the next character, one at a time
+        """
+        self.take("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.take(",]") == "]":
+                return
+
+    def iter_object(self):
+        """
+        Yields the keys of the object that starts at the next character. The caller reads each key's value
+        with value() or iter_array() before asking for the next key.
+        """
+        self.take("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.take(":")
+            yield key
+            if self.take(",}") == "}":
+                return
+
+
+class BloomFilter:
+    """
+    Fixed-size Bloom filter of strings. Membership can be a false positive but never a false negative.
+    Each value sets four bits, taken from the two halves of two 64-bit hashes.
+    """
+    __slots__ = ('bits', 'size')
+
+    def __init__(self, size=BLOOM_BITS):
+        self.bits: bytearray = bytearray(size // 8)
+        self.size: int = size
+
+    def add(self, value):
+        """
+        Adds a value to the filter
+
+        :return: True if the value may have been added before, False if it definitely wasn't
+        """
+        first = hash(value)
+        second = hash((value, 1))
+        size = self.size
+        bits = self.bits
+        present = True
+        for position in ((first & 0xFFFFFFFF) % size, (first >> 32) % size,
+                         (second & 0xFFFFFFFF) % size, (second >> 32) % size):
+            byte, bit = position >> 3, 1 << (position & 7)
+            if not bits[byte] & bit:
+                present = False
+                bits[byte] |= bit
+        return present
+
+
+class IdIndex:
+    """
+    Index of the @ids written to the ingest file so far, the institution each came from and the hash of its record,
+    kept in a SQLite database on disk so memory stays the same however many records are compiled. A Bloom filter
+    in front of it means only @ids that may have been seen before are looked up. The index also holds the delta
+    against the previous delivery once it's worked out, see write_delta.
+    """
+
+    def __init__(self, directory):
+        self.db = sqlite3.connect(os.path.join(directory, "ids.sqlite"))
+        # The index only lives as long as the compile, so it doesn't need to survive a crash
+        self.db.execute("PRAGMA journal_mode = OFF")
+        self.db.execute("PRAGMA synchronous = OFF")
+        self.db.execute("CREATE TABLE ids (id TEXT PRIMARY KEY, institution TEXT, hash TEXT) WITHOUT ROWID")
+        self.db.execute("CREATE TABLE delta (id TEXT PRIMARY KEY, kind TEXT) WITHOUT ROWID")
+        self.bloom = BloomFilter()
+        # New @ids not yet written to the database
+        self.pending = {}
+
+    def add(self, id, institution, hash=None):
+        """
+        Adds an @id to the index, unless it's already there
+
+        :param id: record @id
+        :param institution: institution the record came from
+        :param hash: hash of the record, see get_record_hash
+        :return: the institution the @id was first added from if it's a duplicate, otherwise None
+        """
+        if self.bloom.add(id):
+            if id in self.pending:
+                return self.pending[id][0]
+            row = self.db.execute("SELECT institution FROM ids WHERE id = ?", (id,)).fetchone()
+            if row:
+                return row[0]
+        self.pending[id] = (institution, hash)
+        if len(self.pending) >= INDEX_BATCH_SIZE:
+            self.flush()
+        return None
+
+    def flush(self):
+        # Inserting in key order keeps writes to the index's B-tree together
+        self.db.executemany("INSERT INTO ids VALUES (?, ?, ?)",
+                            ((id, institution, hash) for id, (institution, hash) in sorted(self.pending.items())))
+        self.db.commit()
+        self.pending.clear()
+
+    def iter_hashes(self):
+        """
+        Yields the @id and record hash of every record added, in @id order
+        """
+        self.flush()
+        yield from self.db.execute("SELECT id, hash FROM ids ORDER BY id")
+
+    def add_delta(self, rows):
+        """
+        :param rows: @id and kind (added, changed or deleted) of each record that differs from the previous delivery
+        """
+        self.db.executemany("INSERT INTO delta VALUES (?, ?)", rows)
+        self.db.commit()
+
+    def has_changes(self):
+        """
+        Returns whether any record was added or changed since the previous delivery
+        """
+        return self.db.execute("SELECT 1 FROM delta WHERE kind != 'deleted' LIMIT 1").fetchone() is not None
+
+    def get_delta(self, id):
+        row = self.db.execute("SELECT kind FROM delta WHERE id = ?", (id,)).fetchone()
+        return row[0] if row else None
+
+    def iter_deleted(self):
+        for row in self.db.execute("SELECT id FROM delta WHERE kind = 'deleted' ORDER BY id"):
+            yield row[0]
+
+    def close(self):
+        self.db.close()
+
+
+def get_zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise Exception("zstd compression needs the zstandard package, see requirements.txt")
+    return zstandard
+
+
+def strip_compression(name):
+    """
+    Returns a file name without its compression suffix, e.g. shsm.jsonl for shsm.jsonl.gz
+    """
+    for suffix in COMPRESSIONS.values():
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+def get_compressed_path(path, compression=None):
+    return path + COMPRESSIONS[compression] if compression else path
+
+
+def compress(stream, compression=None):
+    """
+    Wraps a binary stream for writing text, compressed with gzip or zstd if set. Closing the text stream finishes
+    the compressed data but leaves the binary stream open.
+
+    :param stream: binary stream
+    :param compression: None, gzip or zstd
+    :return: text stream
+    """
+    if compression == "gzip":
+        # mtime is left out of the header so that the same records always give the same checksum
+        stream = gzip.GzipFile(fileobj=stream, mode="wb", compresslevel=GZIP_LEVEL, mtime=0)
+    elif compression == "zstd":
+        stream = get_zstandard().ZstdCompressor(level=ZSTD_LEVEL).stream_writer(stream, closefd=False)
+    elif compression is not None:
+        raise ValueError(f"Unknown compression {compression}, expected one of {', '.join(COMPRESSIONS)}")
+    else:
+        stream = NonClosingWriter(stream)
+    return io.TextIOWrapper(stream, encoding="utf-8")
+
+
+def decompress(stream):
+    """
+    Wraps a binary stream for reading text, decompressing it if it starts like gzip or zstd data.
+    Closing the text stream leaves the binary stream open.
+
+    :param stream: binary stream that supports peek(), e.g. a file opened with "rb" or a zip member
+    :return: text stream
+    """
+    magic = stream.peek(len(ZSTD_MAGIC))[:len(ZSTD_MAGIC)]
+    if magic.startswith(GZIP_MAGIC):
+        stream = gzip.GzipFile(fileobj=stream, mode="rb")
+    elif magic == ZSTD_MAGIC:
+        stream = get_zstandard().ZstdDecompressor().stream_reader(stream, closefd=False)
+    else:
+        stream = NonClosingReader(stream)
+    return io.TextIOWrapper(stream, encoding="utf-8")
+
+
+@contextmanager
+def open_input(path):
+    """
+    Opens an output file for reading as text, whether it's compressed or not
+    """
+    with open(path, "rb") as raw, decompress(raw) as inf:
+        yield inf
+
+
+@contextmanager
+def open_output(path, compression=None):
+    """
+    Opens a file for writing as text, compressed with gzip or zstd if set. The path should already have the
+    compression's suffix, see get_compressed_path.
+    """
+    with open(path, "wb") as raw, compress(raw, compression) as outf:
+        yield outf
+
+
+def remove_other_compressions(path):
+    """
+    Removes the copies of a file written with other compressions, so that readers looking for the file
+    don't find a stale one
+    """
+    base = strip_compression(path)
+    for other in [base] + [base + suffix for suffix in COMPRESSIONS.values()]:
+        if other != path and os.path.exists(other):
+            os.remove(other)
+
+
+class NonClosingReader(io.RawIOBase):
+    """
+    Binary stream that reads from another one without closing it, the uncompressed counterpart of
+    GzipFile(fileobj=...)
+    """
+    def __init__(self, stream):
+        self.stream = stream
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.stream.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+class NonClosingWriter(io.RawIOBase):
+    """
+    Binary stream that writes to another one without closing it, the uncompressed counterpart of
+    GzipFile(fileobj=...)
+    """
+    def __init__(self, stream):
+        self.stream = stream
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.stream.write(data)
+        return len(data)
+
+    def flush(self):
+        if not self.closed:
+            self.stream.flush()
+
+
+class ChecksumWriter(io.RawIOBase):
+    """
+    Binary file that keeps a SHA-256 checksum and a count of the bytes written to it, and that can hand the bytes
+    on to an upload as they're written
+    """
+    def __init__(self, path, upload=None):
+        """
+        :param path: path to the file
+        :param upload: if set, object with write() and close() the file's bytes are also written to,
+            e.g. upload_s3.MultipartUpload
+        """
+        self.file = open(path, "wb")
+        self.upload = upload
+        self.sha256 = hashlib.sha256()
+        self.size: int = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        self.file.write(data)
+        if self.upload is not None:
+            self.upload.write(bytes(data))
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self.file.close()
+            if self.upload is not None:
+                self.upload.close()
+        super().close()
+
+
+class OutputFile:
+    """
+    Text file listed in the ingest file's manifest: written through a ChecksumWriter, compressed and uploaded if set,
+    and counting the lines written to it
+    """
+
+    def __init__(self, path, compression=None, upload=None):
+        self.file = ChecksumWriter(path, upload(path) if upload else None)
+        self.outf = compress(self.file, compression)
+        self.count: int = 0
+
+    def write(self, line):
+        self.outf.write(line)
+        self.count += 1
+
+    def close(self):
+        """
+        :return: manifest entry with the file's name, line count, size and SHA-256 checksum
+        """
+        self.outf.close()
+        self.file.close()
+        return {
+            "path": os.path.basename(self.file.file.name),
+            "count": self.count,
+            "size": self.file.size,
+            "sha256": self.file.sha256.hexdigest()
+        }
+
+
+class PartWriter:
+    """
+    Writes the lines of the ingest file, compressed if set, to a single file or, if part_size is set, to numbered part
+    files of about part_size bytes each (mohub_ingest-00001.jsonl.gz, ...). Closing it writes a manifest next to
+    the parts with the record count, size and SHA-256 checksum of each, and of any other files written with open_file.
+    If upload is set, each file is uploaded as it's written, the manifest last.
+    """
+
+    def __init__(self, out_path, compression=None, part_size=None, upload=None):
+        """
+        :param out_path: path to the ingest file, e.g. mohub_ingest.jsonl
+        :param compression: None, gzip or zstd
+        :param part_size: size in bytes, as written to disk, after which a new part file is started
+        :param upload: if set, function that starts the upload of the file at a path and returns an object its bytes
+            are written to, e.g. upload_s3.start_upload
+        """
+        self.out_path: str = out_path
+        self.stem: str = os.path.splitext(out_path)[0]
+        self.compression: str = compression
+        self.part_size: int = part_size
+        self.upload = upload
+        self.parts: list = []
+        self.count: int = 0
+        # OutputFile of the part being written
+        self.part = None
+
+    def get_part_path(self, number):
+        if not self.part_size:
+            return get_compressed_path(self.out_path, self.compression)
+        ext = os.path.splitext(self.out_path)[1]
+        return get_compressed_path(f"{self.stem}-{number:05d}{ext}", self.compression)
+
+    def get_path(self, suffix):
+        """
+        Returns the path to a file written next to the ingest file, e.g. mohub_ingest.hashes.tsv for .hashes.tsv
+        """
+        return get_compressed_path(self.stem + suffix, self.compression)
+
+    def get_part_paths(self):
+        directory = os.path.dirname(self.out_path)
+        return [os.path.join(directory, part['path']) for part in self.parts]
+
+    def open_file(self, suffix):
+        """
+        Opens a file next to the ingest file, compressed and uploaded like its parts
+        """
+        return OutputFile(self.get_path(suffix), self.compression, self.upload)
+
+    def start_part(self):
+        self.part = OutputFile(self.get_part_path(len(self.parts) + 1), self.compression, self.upload)
+
+    def write(self, line):
+        if self.part is None:
+            self.start_part()
+        self.part.write(line)
+        self.count += 1
+        if self.part_size and self.part.file.size >= self.part_size:
+            self.finish_part()
+
+    def finish_part(self):
+        self.parts.append(self.part.close())
+        self.part = None
+
+    def finish(self):
+        """
+        Finishes the last part
+
+        :return: manifest, with the compression, total record count and parts
+        """
+        if self.part is None and not self.parts:
+            # No records, but there's still an (empty) ingest file
+            self.start_part()
+        if self.part is not None:
+            self.finish_part()
+        return {
+            "compression": self.compression,
+            "count": self.count,
+            "parts": self.parts
+        }
+
+    def write_manifest(self, manifest):
+        manifest_path = self.stem + MANIFEST_SUFFIX
+        with open(manifest_path, "w") as outf:
+            json.dump(manifest, outf, indent=4)
+        if self.upload:
+            upload = self.upload(manifest_path)
+            with open(manifest_path, "rb") as inf:
+                upload.write(inf.read())
+            upload.close()
+
+    def close(self):
+        """
+        Finishes the last part and writes the manifest
+
+        :return: manifest
+        """
+        manifest = self.finish()
+        self.write_manifest(manifest)
+        return manifest
+
+
+def get_record_hash(record):
+    """
+    Returns a hash of a record's content that doesn't depend on the order of its keys
+    """
+    return hashlib.blake2b(hash_encoder.encode(record).encode("utf-8"), digest_size=16).hexdigest()
+
+
+def iter_hashes(path):
+    """
+    Yields the @id and record hash on each line of a hashes file written by write_delta, checking they're in @id order
+    """
+    last = None
+    with open_input(path) as inf:
+        for line in inf:
+            id, hash = line.rstrip("\n").split("\t")
+            if last is not None and id <= last:
+                raise Exception(f"{path} isn't sorted by @id, {id} comes after {last}")
+            last = id
+            yield id, hash
+
+
+def diff_hashes(previous, current):
+    """
+    Compares two sequences of @id and record hash, both in @id order, in a single pass over each
+
+    :param previous: @ids and hashes of the previous delivery
+    :param current: @ids and hashes of this one
+    :return: generator of @id and kind (added, changed or deleted) of each record that differs
+    """
+    previous = iter(previous)
+    current = iter(current)
+    old = next(previous, None)
+    new = next(current, None)
+    while old is not None or new is not None:
+        if new is None or (old is not None and old[0] < new[0]):
+            yield old[0], "deleted"
+            old = next(previous, None)
+        elif old is None or new[0] < old[0]:
+            yield new[0], "added"
+            new = next(current, None)
+        else:
+            if old[1] != new[1]:
+                yield new[0], "changed"
+            old = next(previous, None)
+            new = next(current, None)
+
+
+def write_delta(index, writer, previous_hashes=None):
+    """
+    Writes the hashes file for the ingest file just written ({stem}.hashes.tsv, an @id and record hash per line
+    in @id order) and, if the previous delivery's hashes file is given, the records added and changed since then
+    ({stem}.added.jsonl and {stem}.changed.jsonl) and the @ids of those deleted ({stem}.deleted.txt).
+
+    The previous and current hashes are merged in @id order, so only a line of each is in memory at a time. The kind
+    of each record that differs is kept in the index, and the added and changed records are then copied out of
+    the ingest file's parts.
+
+    :param index: IdIndex the ingest file's records were added to
+    :param writer: PartWriter the ingest file was written with, already finished
+    :param previous_hashes: path to the previous delivery's hashes file
+    :return: manifest entries for the hashes file, and for the added, changed and deleted files or None
+    """
+    def iter_current():
+        for id, hash in index.iter_hashes():
+            hashes_file.write(f"{id}\t{hash}\n")
+            yield id, hash
+
+    with tempfile.TemporaryDirectory() as previous_dir:
+        hashes_path = writer.get_path(".hashes.tsv")
+        if previous_hashes and os.path.exists(hashes_path) and os.path.samefile(previous_hashes, hashes_path):
+            # The previous hashes file is about to be overwritten, so it's read from a copy
+            previous_hashes = shutil.copy(previous_hashes, previous_dir)
+        hashes_file = writer.open_file(".hashes.tsv")
+        if previous_hashes:
+            index.add_delta(diff_hashes(iter_hashes(previous_hashes), iter_current()))
+        else:
+            for row in iter_current():
+                pass
+        hashes = hashes_file.close()
+    if not previous_hashes:
+        return hashes, None
+
+    delta_files = {"added": writer.open_file(".added.jsonl"), "changed": writer.open_file(".changed.jsonl")}
+    for path in writer.get_part_paths() if index.has_changes() else []:
+        with open_input(path) as inf:
+            for line in inf:
+                record = json.loads(line)
+                kind = index.get_delta(record["@id"]) if "@id" in record else None
+                if kind is not None:
+                    delta_files[kind].write(line)
+    deleted_file = writer.open_file(".deleted.txt")
+    for id in index.iter_deleted():
+        deleted_file.write(f"{id}\n")
+    delta = {kind: delta_file.close() for kind, delta_file in delta_files.items()}
+    delta["deleted"] = deleted_file.close()
+    return hashes, delta
+
+
+def iter_json_records(stream):
+    """
+    Yields the records of a JSON output file, or of a JSON array of records, one at a time
+
+    :param stream: text stream
+    """
+    reader = JSONReader(stream)
+    if reader.peek() == "[":
+        yield from reader.iter_array()
+        return
+    for key in reader.iter_object():
+        if key == "records":
+            yield from reader.iter_array()
+        else:
+            reader.value()
+
+
+def read_json_summary(stream):
+    """
+    Reads everything in a JSON output file except its records, which are read past one at a time without being kept
+
+    :param stream: text stream
+    :return: dict with institution, count, skipped and retries
+    """
+    reader = JSONReader(stream)
+    summary = {}
+    for key in reader.iter_object():
+        if key == "records":
+            for record in reader.iter_array():
+                pass
+        else:
+            summary[key] = reader.value()
+    return summary
+
+
+def iter_stream_records(stream, name):
+    """
+    Yields the records of an output file read from a text stream
+
+    :param stream: text stream
+    :param name: file name, which tells JSONL from JSON
+    """
+    if not strip_compression(name).endswith(".jsonl"):
+        yield from iter_json_records(stream)
+        return
+    for line in stream:
+        if line.strip():
+            yield json.loads(line)
+
+
+def is_data_file(name):
+    name = strip_compression(name)
+    return (name.endswith(".json") or name.endswith(".jsonl")) and not name.endswith(SUMMARY_SUFFIX)
+
+
+def get_institution_id(name):
+    """
+    Returns the institution id an output file is named after, e.g. shsm for ./shsm_data/shsm.json or shsm.jsonl.gz
+    """
+    return os.path.basename(strip_compression(name)).rsplit(".", 1)[0]
+
+
+def iter_institution_records(path):
+    """
+    Yields the records in an output file, or in every output file in a zip archive without extracting it,
+    along with the id of the institution whose file each record is in
+
+    :param path: path to a .json, .jsonl or .zip file, the first two compressed or not
+    :return: generator of institution id and record
+    """
+    if not path.endswith(".zip"):
+        with open_input(path) as inf:
+            institution = get_institution_id(path)
+            for record in iter_stream_records(inf, path):
+                yield institution, record
+        return
+    with zipfile.ZipFile(path, "r") as archive:
+        for name in archive.namelist():
+            if not is_data_file(name):
+                continue
+            institution = get_institution_id(name)
+            with archive.open(name) as member, decompress(member) as inf:
+                for record in iter_stream_records(inf, name):
+                    yield institution, record
+
+
+def iter_records(path):
+    """
+    Yields the records in an output file, or in every output file in a zip archive, without extracting it
+
+    :param path: path to a .json, .jsonl or .zip file
+    """
+    for institution, record in iter_institution_records(path):
+        yield record
+
+
+def compile(paths, out_path, drop_duplicates=True, compression=None, part_size=None, upload=None, previous_hashes=None):
+    """
+    Writes the records in each file to a single JSONL file, or to part files, a record at a time, along with
+    a manifest (see PartWriter) and a hashes file of each record's content. Records whose @id has already been
+    written are reported, and left out if drop_duplicates is set. If the previous delivery's hashes file is given,
+    the records added, changed and deleted since then are written too, see write_delta.
+
+    :param paths: paths to .json, .jsonl or .zip files
+    :param out_path: path to the JSONL file, without any compression suffix
+    :param drop_duplicates: if set, only the first record with each @id is written
+    :param compression: None, gzip or zstd
+    :param part_size: if set, records are split into part files of about this many bytes
+    :param upload: if set, each file is uploaded as it's written, see PartWriter
+    :param previous_hashes: path to the hashes file of the previous delivery
+    :return: manifest, and Counter of duplicate @ids by (first institution, duplicate's institution)
+    """
+    if previous_hashes and not os.path.exists(previous_hashes):
+        raise Exception(f"No hashes file found at {previous_hashes}")
+    writer = PartWriter(out_path, compression, part_size, upload)
+    collisions = Counter()
+    with tempfile.TemporaryDirectory() as index_dir:
+        index = IdIndex(index_dir)
+        try:
+            for path in paths:
+                print(path)
+                for institution, record in iter_institution_records(path):
+                    first = index.add(record["@id"], institution, get_record_hash(record)) if "@id" in record else None
+                    if first is not None:
+                        collisions[(first, institution)] += 1
+                        if drop_duplicates:
+                            continue
+                    writer.write(json.dumps(record) + "\n")
+            manifest = writer.finish()
+            manifest["hashes"], manifest["delta"] = write_delta(index, writer, previous_hashes)
+        finally:
+            index.close()
+    writer.write_manifest(manifest)
+
+    if collisions:
+        print(f"{sum(collisions.values())} records with duplicate @ids {'left out' if drop_duplicates else 'written'}:")
+        for line in get_collision_lines(collisions):
+            print(line)
+    if manifest["delta"]:
+        delta = manifest["delta"]
+        print(f"Since the previous delivery: {delta['added']['count']} records added, "
+              f"{delta['changed']['count']} changed and {delta['deleted']['count']} deleted")
+    return manifest, collisions
+
+
+def get_collision_lines(collisions):
+    """
+    :param collisions: Counter of duplicate @ids by (first institution, duplicate's institution), as returned by compile
+    :return: lines describing which institutions collided, most duplicates first
+    """
+    return [f"{first} / {duplicate}: {count} duplicate @ids" for (first, duplicate), count in collisions.most_common()]
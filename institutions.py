@@ -9,7 +9,10 @@ import json
         "url": // url to the root OAI endpoint, or data dump,
         "metadata_prefix": // metadata prefix for OAI feed, to be used in constructing the OAI query. If set to 'data_dump', URL assumed to be downloaded as-is,
         "include": // array listing collection names to be included in crawl. If set, only collections listed will be included, otherwise all collections assumed to be included,
-        "exclude": // array listing collection names to be excluded in crawl. If set, all but listed collections will be excluded
+        "exclude": // array listing collection names to be excluded in crawl. If set, all but listed collections will be excluded,
+        "retry": // object overriding the retry policy for the feed's requests (see retry.py),
+        "set_workers": // if more than 1, each set (minus excluded ones) is harvested as its own resumption stream, this many at a time,
+        "rules": // object adding to or overriding the institution's mapping rules (see rules.py)
     }
 """
 
@@ -57,6 +60,9 @@ def get_all_ids():
 
 
 class Institution:
+    __slots__ = ('url', 'id', 'name', 'hub', 'include', 'exclude', 'retry', 'set_workers', 'rules', 'id_prefix',
+                 'preferred_metadata_prefix')
+
     def __init__(self, institution_data):
         # from oai import OAI
         # url and id are required fields, the rest are optional when initializing
@@ -66,6 +72,9 @@ class Institution:
         self.hub = institution_data['hub'] if 'hub' in institution_data else "mohub"
         self.include: list = institution_data['include'] if 'include' in institution_data else []
         self.exclude: list = institution_data['exclude'] if 'exclude' in institution_data else []
+        self.retry: dict = institution_data['retry'] if 'retry' in institution_data else {}
+        self.set_workers: int = institution_data['set_workers'] if 'set_workers' in institution_data else 1
+        self.rules: dict = institution_data['rules'] if 'rules' in institution_data else {}
         self.id_prefix: str = self.generate_id_prefix()
         self.preferred_metadata_prefix: str = institution_data['metadata_prefix'] if 'metadata_prefix' in institution_data else None
         # self.oai = OAI(self)
@@ -1,10 +1,102 @@
 from oai import OAI
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import argparse
+import traceback
+import cache
+import ingest
+import parsers
+import session
 import utils
-import requests
 import institutions
 
 
+def harvest(institution, incremental=False, resume=False, checkpoint_pages=0, set_workers=None, jsonl=False, map_workers=1,
+            compression=None):
+    """
+    Crawls a single institution's feed and writes its output file
+
+    :param institution: Institution object
+    :param incremental: if set, only records changed since the last successful harvest are requested and merged into the previous output
+    :param resume: if set, an interrupted harvest is picked up from its last checkpoint
+    :param checkpoint_pages: number of pages between checkpoints, 0 for none
+    :param set_workers: overrides the institution's set_workers setting
+    :param jsonl: if set, records are streamed to {id}.jsonl as they're harvested instead of being written to {id}.json at the end
+    :param map_workers: number of processes pages are parsed and mapped in
+    :param compression: None, gzip or zstd compression for the output file
+    :return: count of records written and count of records skipped
+    """
+    if institution.id == 'mhm' and cache.MODE == 'replay':
+        print(f"{institution.id} is a data dump feed and can't be replayed from the cache, continuing.")
+        return 0, 0
+
+    if institution.id == 'mhm':
+        # Missouri History Museum provides a data dump feed instead of an OAI feed
+        data = utils.get_datadump(institution.url)
+        skipped = 0
+        utils.write_file("files/institutions/", data, institution.id, institution.name, 0, {}, compression=compression)
+        count = len(data)
+
+    else:
+        # Create OAI object based on input data
+        feed = OAI(institution)
+        set_workers = set_workers or institution.set_workers
+        state = utils.get_harvest_state(institution.id) if incremental else None
+        from_date = None
+
+        if jsonl:
+            previous_path = utils.find_data_file(institution.id) if state else None
+            writer = utils.JSONLWriter(institution.id, track_ids=bool(previous_path), compression=compression)
+            if previous_path:
+                print(f"Harvesting records changed since {state['datestamp']}")
+                from_date = state['datestamp']
+            data, skipped, skipped_messages = feed.crawl(from_date=from_date, checkpoint_pages=checkpoint_pages, resume=resume,
+                                                         set_workers=set_workers, writer=writer, map_workers=map_workers)
+            if feed.complete:
+                if previous_path:
+                    utils.merge_previous_records(writer, previous_path, feed.deleted)
+                writer.close(institution.name, skipped, skipped_messages, feed.retries)
+            else:
+                # The records so far stay in the temporary file for --resume, and the previous output stays in place
+                writer.stop()
+                print(f"\nHarvest of {institution.id} stopped early, {writer.path} was left as it was.")
+            count = writer.count
+        else:
+            previous = utils.load_previous_records(institution.id) if state else None
+
+            # Crawl the feed and write output to JSON
+            if previous is not None:
+                print(f"Harvesting records changed since {state['datestamp']}")
+                from_date = state['datestamp']
+            data, skipped, skipped_messages = feed.crawl(from_date=from_date, checkpoint_pages=checkpoint_pages, resume=resume, set_workers=set_workers,
+                                                         map_workers=map_workers)
+            if previous is not None:
+                data = utils.merge_records(previous, data, feed.deleted)
+            utils.write_file("files/institutions/", data, institution.id, institution.name, skipped, skipped_messages, feed.retries,
+                             compression)
+            count = len(data)
+
+        # The next incremental harvest starts from this one, as long as no pages were lost
+        if incremental and feed.complete and feed.response_date and cache.MODE != 'replay':
+            granularity = feed.get_granularity()
+            utils.set_harvest_state(institution.id, {
+                "datestamp": feed.format_datestamp(feed.response_date, granularity),
+                "granularity": granularity
+            })
+
+    print(f"Total records: {count}")
+    print(f"Total skipped: {skipped}")
+
+    return count, skipped
+
+
+def finish(args):
+    session.report()
+    if args.cache:
+        removed = cache.evict()
+        if removed:
+            print(f"Evicted {removed} responses from the cache.")
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--institutions', '-i', nargs='*',
@@ -17,9 +109,46 @@ def main():
                         action="store_true", help="If set, converts JSON output to CSV.")
     parser.add_argument('--compile_only', '-co', default=False,
                         help="If set, script doesn't run a crawl, only compiles all data files into one.", action="store_true")
+    parser.add_argument('--workers', '-w', type=int, default=1,
+                        help="Number of institutions to crawl concurrently.")
+    parser.add_argument('--host_limit', '-hl', type=int, default=session.MAX_REQUESTS_PER_HOST,
+                        help="Maximum number of concurrent requests sent to a single host.")
+    parser.add_argument('--timeout', '-t', type=float, default=None,
+                        help="Default timeout in seconds for HTTP requests.")
+    parser.add_argument('--incremental', '-inc', default=False, action="store_true",
+                        help="If set, only harvests records changed since the last successful harvest and merges them into the previous output.")
+    parser.add_argument('--resume', '-r', default=False, action="store_true",
+                        help="If set, picks up interrupted harvests from their last checkpoint.")
+    parser.add_argument('--checkpoint_pages', '-cp', type=int, default=None,
+                        help="Number of pages harvested between checkpoints. Defaults to 10 with --resume or --jsonl, otherwise to 0, which disables checkpoints.")
+    parser.add_argument('--set_workers', '-sw', type=int, default=None,
+                        help="Number of sets harvested in parallel within a feed. Overrides set_workers in the input file.")
+    parser.add_argument('--jsonl', '-jl', default=False, action="store_true",
+                        help="If set, records are streamed to <id>.jsonl with a <id>.summary.json summary as they're harvested, instead of written to <id>.json at the end.")
+    parser.add_argument('--map_workers', '-mw', type=int, default=1,
+                        help="Number of processes each feed's pages are parsed and mapped in.")
+    parser.add_argument('--compression', '-cz', choices=list(ingest.COMPRESSIONS.keys()), default=None,
+                        help="Compresses each feed's output file with gzip or zstd (zstd needs the zstandard package).")
+    parser.add_argument('--cache', '-c', default=False, action="store_true",
+                        help="If set, raw OAI responses are saved to the on-disk cache.")
+    parser.add_argument('--replay', '-rp', default=False, action="store_true",
+                        help="If set, feeds are crawled from the on-disk cache without any network requests.")
+    parser.add_argument('--parser', '-p', choices=list(parsers.PARSERS.keys()), default=parsers.DEFAULT_PARSER,
+                        help="Backend used to parse ListRecords pages.")
+    parser.add_argument('--cache_max_mb', type=int, default=cache.MAX_SIZE_MB,
+                        help="Size of the response cache above which the oldest responses are evicted.")
+    parser.add_argument('--cache_max_days', type=int, default=cache.MAX_AGE_DAYS,
+                        help="Age in days after which cached responses are evicted.")
     args = parser.parse_args()
+    if args.checkpoint_pages is None:
+        # Without --jsonl a checkpoint holds every record harvested so far, so they're only written when they may be resumed from
+        args.checkpoint_pages = 10 if args.resume or args.jsonl else 0
 
+    session.configure(timeout=args.timeout, max_requests_per_host=args.host_limit)
+    parsers.configure(args.parser)
+    cache.configure('replay' if args.replay else 'record' if args.cache else None, args.cache_max_mb, args.cache_max_days)
     institutions_data = institutions.get()
+    to_crawl = []
 
     for institution in institutions_data:
         if args.institutions:
@@ -27,27 +156,37 @@ def main():
                 continue
 
         # In order not to crawl redundantly, by default we skip crawls from the past 24 hours
-        if utils.crawled_recently(institution.id, args.crawl_time or 24) and not args.ignore_time:
+        if utils.crawled_recently(institution.id, args.crawl_time or 24) and not (args.ignore_time or args.replay):
             print("{} has been crawled in less than {} hours, continuing.".format(institution.id, args.crawl_time))
             continue
 
-        if institution.id == 'mhm':
-            # Missouri History Museum provides a data dump feed instead of an OAI feed
-            data = requests.get(institution.url).json()
-            metadata = data['records']
-            skipped = 0
-            utils.write_file("files/institutions/", metadata, institution.id, institution.name, 0, {})
+        to_crawl.append(institution)
 
-        else:
-            # Create OAI object based on input data
-            feed = OAI(institution)
+    if args.workers <= 1:
+        for institution in to_crawl:
+            harvest(institution, args.incremental, args.resume, args.checkpoint_pages, args.set_workers, args.jsonl, args.map_workers,
+                    args.compression)
+        finish(args)
+        return
 
-            # Crawl the feed and write output to JSON
-            data, skipped, skipped_messages = feed.crawl()
-            utils.write_file("files/institutions/", data, institution.id, institution.name, skipped, skipped_messages)
+    # A failure in one feed is reported but doesn't stop the other feeds from being crawled
+    failed = []
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(harvest, institution, args.incremental, args.resume, args.checkpoint_pages, args.set_workers, args.jsonl, args.map_workers, args.compression): institution for institution in to_crawl}
+        for future in as_completed(futures):
+            institution = futures[future]
+            try:
+                count, skipped = future.result()
+            except Exception:
+                failed.append(institution.id)
+                print(f"\nCrawl failed for {institution.id}:")
+                traceback.print_exc()
+                continue
+            print(f"\n{institution.id} finished: {count} records, {skipped} skipped")
 
-        print(f"Total records: {len(data)}")
-        print(f"Total skipped: {skipped}")
+    finish(args)
+    if failed:
+        print(f"\nFailed crawls: {', '.join(failed)}")
 
 
 if __name__ == "__main__":
@@ -1,22 +0,0 @@
-from maps import *
-
-map_list = {
-    "frb": frb,
-    "msu": cdm,
-    "kcpl1": kcpl1,
-    "kcpl2": kcpl2,
-    "umkc": um,
-    "stlpl": cdm,
-    "shsm": cdm,
-    "mdh": cdm,
-    "slu": cdm,
-    "umsl": um,
-    "sgcl": cdm,
-    "wustl1": wustl1,
-    "wustl2": wustl2,
-    "lhl": lhl,
-    "drake": cdm,
-    "grinnell": grinnell,
-    "uni": uni,
-    "isu": isu
-}
\ No newline at end of file
@@ -3,8 +3,7 @@ import utils
 
 def cdm(metadata):
     url = metadata["identifier"][-1]
-    thumbnail = utils.generate_cdm_thumbnail(metadata["identifier"][-1])
-    iiif_manifest = utils.generate_cdm_iiif_manifest(metadata["identifier"][-1])
+    thumbnail, iiif_manifest = utils.generate_cdm_urls(url)
     return url, thumbnail, iiif_manifest
 
 
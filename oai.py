@@ -1,10 +1,78 @@
 import requests
 from bs4 import BeautifulSoup
 from record import Record, OAIRecordException
+from retry import RetryPolicy
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import html
+import json
+import multiprocessing
+import queue
+import re
+import threading
 import time
 import sys
+import tempfile
+import cache
+import parsers
+import rules
+import session
 import utils
 
+# Number of ListRecords pages that can be downloaded ahead of the page currently being parsed
+PREFETCH_PAGES = 2
+# Number of pages per mapping worker that can be queued ahead of the page currently being written
+MAP_PAGES_PER_WORKER = 2
+BAD_RESUMPTION_TOKEN_PATTERN = re.compile(rb'<error[^>]*code=["\']badResumptionToken["\']', re.IGNORECASE)
+RESUMPTION_TOKEN_PATTERN = re.compile(rb'<resumptiontoken\b[^>]*?(?:/>|>(.*?)</resumptiontoken\s*>)', re.IGNORECASE | re.DOTALL)
+
+# Set in each mapping worker process by init_map_worker
+map_worker = {}
+
+
+def map_page_records(page, oai_data):
+    """
+    Maps every record in a parsed page
+
+    :param page: page object returned by the parser backend
+    :param oai_data: feed data records are mapped with, from OAI.get_oai_data
+    :return: number of records on the page, mapped records, and (reason, record) for each record skipped
+    """
+    records = 0
+    out = []
+    skips = []
+    for record in page:
+        records += 1
+        try:
+            out_record = Record(record, oai_data)
+            mapped_out_record = out_record.map()
+            out.append(mapped_out_record)
+        except OAIRecordException as e:
+            skips.append((e.message, e.record))
+            continue
+    return records, out, skips
+
+
+def init_map_worker(oai_data, rule_overrides, parser_name):
+    """
+    Sets up a mapping worker process. Compiled rules hold functions that can't be sent between processes,
+    so each worker compiles the feed's rules itself.
+    """
+    map_worker["oai_data"] = dict(oai_data, rules=rules.compile(oai_data["institution_id"], rule_overrides))
+    map_worker["parser"] = parsers.get_parser(parser_name)
+
+
+def map_page(content):
+    """
+    Parses and maps a raw ListRecords page in a mapping worker process
+
+    :param content: raw response body
+    :return: number of records on the page, mapped records, (reason, record) for each record skipped, and the page's responseDate
+    """
+    page = map_worker["parser"].parse(content)
+    records, out, skips = map_page_records(page, map_worker["oai_data"])
+    return records, out, skips, page.response_date
+
 
 class OAI:
     def __init__(self, institution):
@@ -15,8 +83,30 @@ class OAI:
         self.metadata_prefix = self.get_metadata_prefix()
         self.include = institution.include
         self.exclude = institution.exclude
+        # Records are checked against excluded collections by hash rather than by scanning the list
+        self.exclude_set = frozenset(self.exclude)
         self.hub = institution.hub
+        self.retry_policy = RetryPolicy.from_config(institution.retry)
+        self.rule_overrides = institution.rules
+        self.rules = rules.compile(self.id, self.rule_overrides)
+        if not self.rules.url_function:
+            print(f"No mapping found for {self.id}, its records will be skipped.")
+        self.parser_name = parsers.DEFAULT_PARSER
+        self.parser = parsers.get_parser(self.parser_name)
         self.skipped_record_messages = {}
+        self.retries = {}
+        # Guards retry and skip counters, which are shared by set streams harvested in parallel
+        self.retries_lock = threading.Lock()
+        # Set during a crawl: whether every page was harvested, the server's responseDate for the first page,
+        # and header identifiers of records the feed reports as deleted
+        self.complete = True
+        self.response_date = None
+        self.deleted = []
+        # JSONLWriter records are streamed to during a crawl, if any
+        self.writer = None
+        # Pool of processes pages are mapped in during a crawl, if any
+        self.map_pool = None
+        self.map_workers = 1
 
     def print_info(self):
         print(f"Institution name: {self.name}")
@@ -24,6 +114,24 @@ class OAI:
         print(f"OAI feed URL: {self.url}")
         print(f"Metadata prefix: {self.metadata_prefix}\n")
 
+    def request(self, params):
+        """
+        Sends a request to the OAI feed. Depending on the cache mode, responses are recorded to or replayed from the on-disk cache.
+
+        :param params: query parameters
+        :return: requests Response, or a CachedResponse when replaying
+        """
+        if cache.MODE == 'replay':
+            content = cache.get(self.url, params)
+            if content is None:
+                raise cache.CacheMissException(self.url, params)
+            return cache.CachedResponse(self.url, content)
+
+        res = session.get(self.url, params=params)
+        if cache.MODE == 'record' and res.status_code == 200 and cache.is_cacheable(params):
+            cache.put(self.url, params, res.content)
+        return res
+
     def oai_request(self, verb):
         """
         Instatiates an OAI feed request, given an OAI verb.
@@ -35,7 +143,7 @@ class OAI:
             "verb": verb
         }
         try:
-            res = requests.get(self.url, params=params)
+            res = self.request(params)
         except requests.exceptions.MissingSchema as e:
             return False
         soup = BeautifulSoup(res.content, 'html.parser')
@@ -99,6 +207,29 @@ class OAI:
             raise
         return name
 
+    def get_granularity(self):
+        """
+        Returns the datestamp granularity the feed supports for selective harvesting, as stated in its Identify endpoint
+
+        :return: 'YYYY-MM-DD' or 'YYYY-MM-DDThh:mm:ssZ'
+        """
+        granularity = self.identify().get('granularity', '')
+        if granularity == 'YYYY-MM-DDThh:mm:ssZ':
+            return granularity
+        return 'YYYY-MM-DD'
+
+    def format_datestamp(self, datestamp, granularity):
+        """
+        Truncates a full UTC datestamp to the granularity supported by the feed
+
+        :param datestamp: datestamp in YYYY-MM-DDThh:mm:ssZ format
+        :param granularity: granularity returned by get_granularity
+        :return: datestamp string usable as a from/until parameter
+        """
+        if granularity == 'YYYY-MM-DD':
+            return datestamp[:10]
+        return datestamp
+
     def list_sets(self):
         """
         For a given OAI feed, return a list of sets and set IDs
@@ -110,100 +241,490 @@ class OAI:
 
         return sets
 
+    def add_retry(self, key, value=1):
+        with self.retries_lock:
+            self.retries[key] = self.retries.get(key, 0) + value
+
     def add_skipped_record(self, reason, record):
-        if reason in self.skipped_record_messages:
-            self.skipped_record_messages[reason].append(record)
+        with self.retries_lock:
+            if reason in self.skipped_record_messages:
+                self.skipped_record_messages[reason].append(record)
+            else:
+                self.skipped_record_messages[reason] = [record]
+
+    def get_resumption_token(self, content):
+        """
+        Pulls the resumption token out of a raw ListRecords response without parsing the whole page,
+        so the next request can be sent before the page is processed.
+
+        :param content: raw response body
+        :return: resumption token string, or None if there isn't one
+        """
+        match = RESUMPTION_TOKEN_PATTERN.search(content)
+        if not match:
+            return None
+        return html.unescape((match.group(1) or b"").decode("utf-8", errors="replace"))
+
+    def fetch_pages(self, params):
+        """
+        Generator that requests ListRecords pages one after another, following resumption tokens.
+
+        :param params: query parameters for the initial request
+        :return: raw content of each page and the resumption token for the page after it
+        """
+        params = dict(params)
+        policy = self.retry_policy
+        timeouts = 0
+        server_errors = 0
+
+        while True:
+            # Some feeds are touchy about requesting too fast, so we back off when a request error is encountered.
+            # Failure counters are consecutive, and reset as soon as a request succeeds.
+            try:
+                res = self.request(params)
+            except (requests.exceptions.ConnectionError, requests.exceptions.ReadTimeout) as e:
+                timeouts += 1
+                self.add_retry('timeouts')
+                if timeouts >= policy.max_timeouts:
+                    print(f"\nRequest has timed out {timeouts} times. Stopping harvest.")
+                    self.complete = False
+                    return
+                delay = policy.get_delay(timeouts)
+                print("\nRequest timed out. Waiting {:.1f} seconds and trying again. Attempt {}".format(delay, timeouts))
+                self.add_retry('waited', delay)
+                time.sleep(delay)
+                continue
+            if policy.should_retry(res):
+                server_errors += 1
+                self.add_retry('server_errors')
+                if server_errors >= policy.max_server_errors:
+                    print(f"\nFeed has returned a server error {server_errors} times. Stopping crawl.")
+                    self.complete = False
+                    return
+                delay = policy.get_delay(server_errors, res)
+                print("\nServer error {}. Waiting {:.1f} seconds and trying request again.".format(res.status_code, delay))
+                self.add_retry('waited', delay)
+                time.sleep(delay)
+                continue
+            timeouts = 0
+            server_errors = 0
+
+            if 'resumptionToken' in params and BAD_RESUMPTION_TOKEN_PATTERN.search(res.content):
+                raise OAIResumptionTokenException(params['resumptionToken'])
+
+            resumption_token = self.get_resumption_token(res.content)
+            yield res.content, resumption_token
+
+            if not resumption_token:
+                return
+            # OAI doesn't like it if you're using a resumption token with a metadataPrefix or set param
+            params = {
+                "verb": "ListRecords",
+                "resumptionToken": resumption_token
+            }
+
+    def prefetch_pages(self, params, size=PREFETCH_PAGES):
+        """
+        Runs fetch_pages on a background thread so the next page is downloaded while the current one is parsed.
+        At most `size` pages are buffered.
+
+        :param params: query parameters for the initial request
+        :param size: maximum number of pages waiting to be parsed
+        :return: raw content of each page and the resumption token for the page after it
+        """
+        pages = queue.Queue(maxsize=size)
+        stop = threading.Event()
+        done = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def fetch():
+            try:
+                for page in self.fetch_pages(params):
+                    if not put(page):
+                        return
+            except Exception as e:
+                put(e)
+            finally:
+                put(done)
+
+        fetcher = threading.Thread(target=fetch, name=f"{self.id}-fetcher", daemon=True)
+        fetcher.start()
+        try:
+            while True:
+                item = pages.get()
+                if item is done:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+
+    def save_checkpoint(self, resumption_token, page_count, out, skipped, from_date, until_date):
+        checkpoint = {
+            "resumption_token": resumption_token,
+            "page_count": page_count,
+            "skipped": skipped,
+            "skipped_record_messages": self.skipped_record_messages,
+            "deleted": self.deleted,
+            "response_date": self.response_date,
+            "from_date": from_date,
+            "until_date": until_date,
+            "records": out
+        }
+        if self.writer:
+            # Records are already on disk, so only the position to carry on writing from is saved
+            del checkpoint["records"]
+            checkpoint["records_offset"] = self.writer.tell()
+            checkpoint["records_count"] = self.writer.count
+        utils.save_checkpoint(self.id, checkpoint)
+
+    def get_oai_data(self):
+        metadata_prefix = self.metadata_prefix
+        if metadata_prefix == 'oai_dc' or metadata_prefix == 'oai_qdc':
+            metadata_prefix = '{}:dc'.format(metadata_prefix)
+        return {
+            "metadata_prefix": metadata_prefix,
+            "institution": self.name,
+            "institution_id": self.id,
+            "institution_id_prefix": self.id_prefix,
+            "exclude": self.exclude_set,
+            "hub": self.hub,
+            "oai_url": self.url,
+            "rules": self.rules
+        }
+
+    def map_records(self, page, out, skips=None):
+        """
+        Maps every record in a parsed page and appends the results to out
+
+        :param page: page object returned by the parser backend
+        :param out: list mapped records are appended to
+        :param skips: if set, list skipped records are appended to as (message, record) instead of being added to the crawl's
+        :return: number of records on the page and number of records skipped
+        """
+        records, mapped, page_skips = map_page_records(page, self.get_oai_data())
+        out.extend(mapped)
+        self.collect_skips(page_skips, skips)
+        return records, len(page_skips)
+
+    def collect_skips(self, page_skips, skips=None):
+        if skips is None:
+            self.add_skipped_records(page_skips)
+        else:
+            skips.extend(page_skips)
+
+    def add_skipped_records(self, skips):
+        for message, record in skips:
+            self.add_skipped_record(message, record)
+            if message == 'Record is deleted' and 'identifier' in record:
+                self.deleted.append(record['identifier'][0])
+
+    def map_pages(self, pages, out, skips=None):
+        """
+        Parses and maps pages in order, appending each page's records to out before it's yielded.
+        If the crawl has a mapping pool, pages are parsed and mapped in its worker processes, several at a time.
+
+        :param pages: (content, next resumption token) pairs
+        :param out: list mapped records are appended to
+        :param skips: if set, list skipped records are appended to instead of being added to the crawl's, see map_records
+        :return: generator of number of records on the page, number of records skipped, the page's responseDate and the next token
+        """
+        if not self.map_pool:
+            for content, next_token in pages:
+                page = self.parser.parse(content)
+                records, skipped = self.map_records(page, out, skips)
+                yield records, skipped, page.response_date, next_token
+            return
+
+        pending = deque()
+        for content, next_token in pages:
+            pending.append((self.map_pool.apply_async(map_page, (content,)), next_token))
+            if len(pending) < self.map_workers * MAP_PAGES_PER_WORKER:
+                continue
+            yield self.collect_page(pending.popleft(), out, skips)
+        while pending:
+            yield self.collect_page(pending.popleft(), out, skips)
+
+    def collect_page(self, pending_page, out, skips=None):
+        result, next_token = pending_page
+        records, mapped, page_skips, response_date = result.get()
+        out.extend(mapped)
+        self.collect_skips(page_skips, skips)
+        return records, len(page_skips), response_date, next_token
+
+    def start_map_pool(self, map_workers):
+        """
+        Starts the pool of processes pages are mapped in
+
+        :param map_workers: number of processes
+        :return: multiprocessing Pool
+        """
+        oai_data = self.get_oai_data()
+        del oai_data["rules"]
+        self.map_workers = map_workers
+        # Forking a process that's running crawl threads can copy a lock another thread holds and deadlock the worker,
+        # spawned workers start from a fresh interpreter and init_map_worker builds what they need
+        context = multiprocessing.get_context("spawn")
+        return context.Pool(map_workers, initializer=init_map_worker, initargs=(oai_data, self.rule_overrides, self.parser_name))
+
+    def emit(self, records, out):
+        """
+        Hands mapped records to the crawl's JSONLWriter if it has one, otherwise adds them to out
+        """
+        if self.writer:
+            self.writer.write(records)
         else:
-            self.skipped_record_messages[reason] = [record]
+            out.extend(records)
+
+    def get_partition_sets(self, set_workers):
+        """
+        Returns the sets to harvest as separate resumption streams, or None if the feed is harvested as a single stream.
+        If include lists several sets, each of them is harvested. Otherwise, if set_workers is more than 1,
+        every set the feed lists is harvested except those in exclude.
+
+        :param set_workers: number of sets to harvest in parallel
+        :return: list of setSpecs, or None
+        """
+        if isinstance(self.include, list) and len(self.include) > 1:
+            return list(self.include)
+        if self.include or set_workers <= 1:
+            return None
+        return [s['setSpec'] for s in self.list_sets() if s['setSpec'] not in self.exclude_set]
+
+    def crawl_set(self, params, prefetch):
+        """
+        Harvests a single set as its own resumption stream. If the crawl has a JSONLWriter, the set's records are spooled
+        to a temporary file page by page rather than held in memory until the set is merged, see crawl_sets.
+
+        :param params: query parameters for the set's initial request
+        :param prefetch: number of pages to download ahead of parsing
+        :return: mapped records, as a list or a temporary file of JSON lines, skipped records as (message, record) pairs,
+            and the responseDate of the set's first page
+        """
+        out = []
+        skips = []
+        count = 0
+        response_date = None
+        spool = tempfile.TemporaryFile("w+") if self.writer else None
+        pages = self.prefetch_pages(params, prefetch) if prefetch else self.fetch_pages(params)
+        try:
+            for records, page_skipped, page_response_date, next_token in self.map_pages(pages, out, skips):
+                response_date = response_date or page_response_date
+                if spool:
+                    for record in out:
+                        spool.write(json.dumps(record) + "\n")
+                    count += len(out)
+                    out.clear()
+                if not records:
+                    break
+        except BaseException:
+            if spool:
+                spool.close()
+            raise
+        finally:
+            pages.close()
+        print(f"\n{params['set']}: {count + len(out)} records added, {len(skips)} records skipped")
+        if spool:
+            spool.seek(0)
+            return spool, skips, response_date
+        return out, skips, response_date
+
+    def iter_unique_records(self, records, seen):
+        """
+        Yields the records whose header identifier, stored in sourceResource.@id, isn't in seen, and adds it to seen
+        """
+        for record in records:
+            identifier = record["sourceResource"]["@id"]
+            if identifier in seen:
+                continue
+            seen.add(identifier)
+            yield record
 
-    def crawl(self):
+    def crawl_sets(self, sets, params, prefetch, set_workers):
+        """
+        Harvests each set as an independent resumption stream, several at a time.
+        Records that belong to more than one set are only kept, or counted as skipped, once, matched on their header identifier.
+
+        :param sets: setSpecs to harvest
+        :param params: query parameters shared by each set's initial request
+        :param prefetch: number of pages to download ahead of parsing, per set
+        :param set_workers: number of sets harvested in parallel
+        :return: mapped records and number of records skipped
+        """
+        print(f"Harvesting {len(sets)} sets, {set_workers} at a time")
+        out = []
+        seen = set()
+        skipped = 0
+        response_dates = []
+        with ThreadPoolExecutor(max_workers=max(1, set_workers)) as executor:
+            futures = [executor.submit(self.crawl_set, dict(params, set=setspec), prefetch) for setspec in sets]
+            # Sets are merged in order, each as soon as it and the sets before it are done
+            for future in futures:
+                records, skips, response_date = future.result()
+                if response_date:
+                    response_dates.append(response_date)
+                unique_skips = []
+                for message, record in skips:
+                    if 'identifier' in record:
+                        if record['identifier'][0] in seen:
+                            continue
+                        seen.add(record['identifier'][0])
+                    unique_skips.append((message, record))
+                self.add_skipped_records(unique_skips)
+                skipped += len(unique_skips)
+                if type(records) is list:
+                    self.emit(self.iter_unique_records(records, seen), out)
+                else:
+                    with records:
+                        self.emit(self.iter_unique_records((json.loads(line) for line in records), seen), out)
+
+        # The earliest page is the safe starting point for the next incremental harvest
+        self.response_date = min(response_dates) if response_dates else None
+        return out, skipped
+
+    def crawl(self, prefetch=PREFETCH_PAGES, from_date=None, until_date=None, checkpoint_pages=0, resume=False, set_workers=1, writer=None,
+              map_workers=1):
         """
         Crawl an OAI feed, parse and format metadata and output it in a DPLA-formatted JSON file
 
+        :param prefetch: number of pages to download ahead of parsing. If 0, pages are requested and parsed in turn.
+        :param from_date: if set, only records changed on or after this datestamp are harvested
+        :param until_date: if set, only records changed on or before this datestamp are harvested
+        :param checkpoint_pages: if set, progress is saved to a checkpoint file every this many pages
+        :param resume: if set, the crawl picks up from the institution's checkpoint file, if there is one
+        :param set_workers: if more than 1, the feed's sets are harvested as separate streams, this many at a time
+        :param writer: if set, records are written to this JSONLWriter page by page instead of being returned
+        :param map_workers: if more than 1, pages are parsed and mapped in this many processes, keeping their order
         :return: metadata and count of skipped records
         """
+        if map_workers > 1 and not self.map_pool:
+            self.map_pool = self.start_map_pool(map_workers)
+            try:
+                return self.crawl(prefetch, from_date, until_date, checkpoint_pages, resume, set_workers, writer, map_workers)
+            finally:
+                self.map_pool.terminate()
+                self.map_pool = None
+
         print(f"{self.name} ({self.id})")
         print(self.id)
         out = []
-        url = self.url
-        metadata_prefix = self.metadata_prefix
-        resumption_token = True
-        records = True
         params = {
             "verb": "ListRecords",
             "metadataPrefix": self.metadata_prefix
         }
-        # TODO: If Include is a list it needs to be iterated through
         if self.include:
-            params["set"] = self.include
+            params["set"] = self.include[0] if isinstance(self.include, list) and len(self.include) == 1 else self.include
+        if from_date:
+            params["from"] = from_date
+        if until_date:
+            params["until"] = until_date
+
+        self.complete = True
+        self.response_date = None
+        self.deleted = []
+        self.skipped_record_messages = {}
+        self.retries = {}
+        self.writer = writer
 
-        timeouts = 0
-        server_errors = 0
         skipped = 0
+        page_count = 0
         potential_urls = {}
         no_map = False
 
-        while records and resumption_token:
-            sys.stdout.write("\r{} records added : {} records skipped".format(len(out), skipped))
-            sys.stdout.flush()
-            # Some feeds are touchy about requesting too fast, so we pause for 5 seconds if a request error is encountered.
-            try:
-                res = requests.get(url, params=params, timeout=30)
-            except (requests.exceptions.ConnectionError, requests.exceptions.ReadTimeout) as e:
-                timeouts += 1
-                print("\nRequest timed out. Waiting 5 seconds and trying again. Attempt {}".format(timeouts))
-                time.sleep(5)
-                if timeouts == 5:
-                    print("\nRequest has timed out 5 times. Stopping harvest.")
-                    break
-                continue
-            if res.status_code // 100 == 5:
-                server_errors += 1
-                print("\nServer error. Waiting 5 seconds and trying request again.")
-                print(res.status_code)
-                time.sleep(5)
-                if server_errors == 5:
-                    print("\nFeed has returned a server error 5 times. Stopping crawl.")
+        sets = self.get_partition_sets(set_workers)
+        if sets is not None:
+            # Each set has its own resumption token, so set-partitioned harvests aren't checkpointed
+            params.pop("set", None)
+            if writer:
+                writer.start()
+            out, skipped = self.crawl_sets(sets, params, prefetch, set_workers)
+            return self.finish_crawl(out, skipped)
+
+        checkpoint = utils.load_checkpoint(self.id) if resume else None
+        if checkpoint and (writer is not None) != ("records_offset" in checkpoint):
+            print("Checkpoint was saved with a different output format, starting over.")
+            checkpoint = None
+        if checkpoint and writer and not writer.start(checkpoint['records_offset'], checkpoint['records_count']):
+            print("Records written before the checkpoint are missing, starting over.")
+            checkpoint = None
+        if writer and not checkpoint:
+            writer.start()
+        if checkpoint:
+            print(f"Resuming from page {checkpoint['page_count']} with {writer.count if writer else len(checkpoint['records'])} records")
+            out = checkpoint.get('records', [])
+            skipped = checkpoint['skipped']
+            page_count = checkpoint['page_count']
+            self.skipped_record_messages = checkpoint['skipped_record_messages']
+            self.deleted = checkpoint['deleted']
+            self.response_date = checkpoint['response_date']
+            from_date = checkpoint['from_date']
+            until_date = checkpoint['until_date']
+            params = {
+                "verb": "ListRecords",
+                "resumptionToken": checkpoint['resumption_token']
+            }
+        resumption_token = params.get("resumptionToken")
+
+        pages = self.prefetch_pages(params, prefetch) if prefetch else self.fetch_pages(params)
+
+        sys.stdout.write("\r{} records added : {} records skipped".format(writer.count if writer else len(out), skipped))
+        sys.stdout.flush()
+        try:
+            for records, page_skipped, response_date, next_token in self.map_pages(pages, out):
+                skipped += page_skipped
+                if writer:
+                    writer.write(out)
+                    out.clear()
+
+                if not self.response_date:
+                    self.response_date = response_date
+                if not records:
                     break
-                continue
-
-            # OAI doesn't like it if you're using a resumption token with a metadataPrefix or set param, so we delete it after initial request
-            if 'metadataPrefix' in params:
-                del params['metadataPrefix']
-            if 'set' in params:
-                del params['set']
-
-            soup = BeautifulSoup(res.content, 'html.parser')
-
-            records = soup.find_all('record')
-            try:
-                resumption_token = soup.find('resumptiontoken').getText()
-            except AttributeError as e:
-                resumption_token = None
-            params['resumptionToken'] = resumption_token
-            for record in records:
-                if metadata_prefix == 'oai_dc' or metadata_prefix == 'oai_qdc':
-                    metadata_prefix = '{}:dc'.format(metadata_prefix)
-                oai_data = {
-                    "metadata_prefix": metadata_prefix,
-                    "institution": self.name,
-                    "institution_id": self.id,
-                    "institution_id_prefix": self.id_prefix,
-                    "exclude": self.exclude,
-                    "hub": self.hub,
-                    "oai_url": self.url
-                }
-
-                try:
-                    out_record = Record(record, oai_data)
-                    mapped_out_record = out_record.map()
-                    out.append(mapped_out_record)
-                except OAIRecordException as e:
-                    skipped += 1
-                    self.add_skipped_record(e.message, e.record)
-                    continue
 
+                page_count += 1
+                resumption_token = next_token
+                if checkpoint_pages and resumption_token and page_count % checkpoint_pages == 0:
+                    self.save_checkpoint(resumption_token, page_count, out, skipped, from_date, until_date)
+
+                sys.stdout.write("\r{} records added : {} records skipped".format(writer.count if writer else len(out), skipped))
+                sys.stdout.flush()
+        except OAIResumptionTokenException:
+            # Tokens expire after a while, in which case the only option is to start over
+            print("\nResumption token has expired. Restarting harvest.")
+            utils.clear_checkpoint(self.id)
+            return self.crawl(prefetch, from_date, until_date, checkpoint_pages, writer=writer, map_workers=map_workers)
+        finally:
+            pages.close()
+
+        if checkpoint_pages:
+            if self.complete:
+                utils.clear_checkpoint(self.id)
+            elif resumption_token:
+                # Save where the harvest stopped so that it can be resumed from the last good token
+                self.save_checkpoint(resumption_token, page_count, out, skipped, from_date, until_date)
+
+        return self.finish_crawl(out, skipped)
+
+    def finish_crawl(self, out, skipped):
         print(f"\n{skipped} items were skipped.")
+        if self.retries:
+            print(f"Retries: {self.retries.get('timeouts', 0)} timeouts, {self.retries.get('server_errors', 0)} server errors, "
+                  f"{self.retries.get('waited', 0):.1f} seconds waited")
         # utils.write_file("files/institutions/", out, self.id, self.name, skipped, self.skipped_record_messages)
 
-        return out, skipped, self.skipped_record_messages
\ No newline at end of file
+        return out, skipped, self.skipped_record_messages
+
+
+class OAIResumptionTokenException(Exception):
+    def __init__(self, resumption_token):
+        self.message = 'Resumption token is invalid or has expired'
+        self.resumption_token = resumption_token
@@ -0,0 +1,187 @@
+from bs4 import BeautifulSoup
+from xml.parsers import expat
+
+"""
+    Parser backends for ListRecords pages. Each backend's parse() returns a page object that yields record elements
+    and exposes the page's responseDate once parsing has started.
+
+    - 'soup' parses the whole page into a BeautifulSoup tree with html.parser, as the crawler always has.
+    - 'xml' stream-parses the page with expat and yields each <record> as soon as it's complete, as a light
+      Element view. Records aren't attached to any tree, so each one is freed once it has been mapped.
+
+    Both backends report element and attribute names the way html.parser does (lower-cased, with the namespace prefix
+    used in the document, and xmlns declarations kept as attributes), so Record.clean_fields produces the same keys.
+"""
+
+DEFAULT_PARSER = 'xml'
+# Size of the chunks fed to the streaming parser
+CHUNK_SIZE = 64 * 1024
+
+
+def configure(name):
+    global DEFAULT_PARSER
+    if name:
+        DEFAULT_PARSER = name
+
+
+def get_parser(name=None):
+    name = name or DEFAULT_PARSER
+    if name not in PARSERS:
+        raise ValueError(f"Unknown parser backend: {name}")
+    return PARSERS[name]
+
+
+class Element:
+    """
+    Read-only view of an XML element, implementing the parts of the BeautifulSoup Tag API used by Record
+    """
+    __slots__ = ('name', 'attrs', 'contents')
+
+    def __init__(self, name, attrs):
+        self.name: str = name
+        self.attrs: dict = attrs
+        # Child elements and text, in document order
+        self.contents: list = []
+
+    def findChildren(self, recursive=True):
+        children = []
+        for child in self.contents:
+            if type(child) is Element:
+                children.append(child)
+                if recursive:
+                    children.extend(child.findChildren())
+        return children
+
+    def find(self, name):
+        """
+        Returns the first descendant element with the given name, depth first, like BeautifulSoup's find
+        """
+        for child in self.contents:
+            if type(child) is not Element:
+                continue
+            if child.name == name:
+                return child
+            found = child.find(name)
+            if found is not None:
+                return found
+        return None
+
+    def getText(self):
+        return "".join(self.iter_text())
+
+    def iter_text(self):
+        stack = [iter(self.contents)]
+        while stack:
+            for item in stack[-1]:
+                if type(item) is Element:
+                    stack.append(iter(item.contents))
+                    break
+                yield item
+            else:
+                stack.pop()
+
+    def has_attr(self, key):
+        return key in self.attrs
+
+    def __getitem__(self, key):
+        return self.attrs[key]
+
+    def __bool__(self):
+        return True
+
+    def __str__(self):
+        return f"<{self.name}>{self.getText()}</{self.name}>"
+
+
+class SoupPage:
+    def __init__(self, content):
+        self.soup = BeautifulSoup(content, 'html.parser')
+        response_date = self.soup.find('responsedate')
+        self.response_date = response_date.getText().strip() if response_date else None
+
+    def __iter__(self):
+        return iter(self.soup.find_all('record'))
+
+
+class XMLPage:
+    def __init__(self, content):
+        self.content = content
+        self.response_date = None
+        self.records_yielded = 0
+
+    def __iter__(self):
+        try:
+            for record in self.stream():
+                self.records_yielded += 1
+                yield record
+        except expat.ExpatError as e:
+            # Some feeds serve pages that aren't well-formed XML, which html.parser tolerates.
+            # Fall back to it for the rest of the page.
+            print(f"\nPage isn't well-formed XML ({e}), parsing it with html.parser instead.")
+            for index, record in enumerate(SoupPage(self.content)):
+                if index >= self.records_yielded:
+                    yield record
+
+    def stream(self):
+        parser = expat.ParserCreate()
+        parser.ordered_attributes = True
+        parser.buffer_text = True
+        stack = []
+        completed = []
+        # Depth of the outermost <record> currently open, so nested elements named 'record' stay inside it
+        record_depth = [None]
+
+        def start(name, attributes):
+            name = name.lower()
+            attrs = {attributes[i].lower(): attributes[i + 1] for i in range(0, len(attributes), 2)}
+            element = Element(name, attrs)
+            if name == 'record' and record_depth[0] is None:
+                record_depth[0] = len(stack)
+            elif stack and record_depth[0] is not None:
+                stack[-1].contents.append(element)
+            stack.append(element)
+
+        def end(name):
+            element = stack.pop()
+            if record_depth[0] == len(stack):
+                record_depth[0] = None
+                completed.append(element)
+            elif element.name == 'responsedate' and self.response_date is None:
+                self.response_date = element.getText().strip()
+
+        def text(data):
+            if stack and (record_depth[0] is not None or stack[-1].name == 'responsedate'):
+                stack[-1].contents.append(data)
+
+        parser.StartElementHandler = start
+        parser.EndElementHandler = end
+        parser.CharacterDataHandler = text
+
+        content = self.content
+        for offset in range(0, len(content), CHUNK_SIZE):
+            parser.Parse(content[offset:offset + CHUNK_SIZE], False)
+            while completed:
+                yield completed.pop(0)
+        parser.Parse(b"", True)
+        while completed:
+            yield completed.pop(0)
+
+
+class SoupParser:
+    name = 'soup'
+
+    def parse(self, content):
+        return SoupPage(content)
+
+
+class XMLParser:
+    name = 'xml'
+
+    def parse(self, content):
+        return XMLPage(content)
+
+
+PARSERS = {
+    'soup': SoupParser(),
+    'xml': XMLParser()
+}
@@ -1,29 +1,96 @@
 from bs4 import BeautifulSoup
 from templates import Template, dpla_template
 import utils
-from map_list import map_list
+import rules
 import sys
 
 
+def get_field_name(name, attrs, passes=1):
+    """
+    Works out an element's field name: the namespace is dropped, the first attribute value is appended,
+    and coverage is counted as subject
+
+    :param name: element name
+    :param attrs: element attributes
+    :param passes: number of times the renaming is applied
+    :return: field name and the name compared against the parent's, or None for both if the element is left out
+    """
+    compare_name = name
+    for i in range(passes):
+        previous = name, compare_name
+        # split DC fields to just get the name without the namespace
+        if len(name.split(':')) > 1:
+            name = name.split(':')[1]
+
+        if 'relateditem' in name.lower() or 'tableofcontents' in name.lower():
+            return None, None
+
+        if attrs:
+            suffix = "_" + list(attrs.values())[0]
+            name = name + suffix
+        compare_name = name
+
+        if name == "coverage":
+            # Coverage gets "counted" as subject
+            name = "subject"
+
+        # Names under nested subjects go through many passes, most of which change nothing or only add the suffix again
+        if not attrs and (name, compare_name) == previous:
+            break
+        if attrs and i == 1 and ':' not in suffix and 'relateditem' not in suffix.lower() and 'tableofcontents' not in suffix.lower():
+            name = compare_name = name + suffix * (passes - 2)
+            break
+    return name, compare_name
+
+
+class Fields:
+    """
+    Row of fields being parsed by Record.clean_fields
+    """
+    __slots__ = ('entries', 'index', 'row')
+
+    def __init__(self, entries):
+        # (child element, field name, passes, repeated name, flatten subject) for each child to parse
+        self.entries: list = entries
+        self.index: int = 0
+        self.row: dict = {}
+
+
+# sourceResource fields whose values repeat across a feed's records, so each distinct value is kept in memory once
+INTERNED_FIELDS = ("rights", "format")
+
+
+def intern_value(value):
+    return sys.intern(value) if type(value) is str else value
+
+
 class Record:
+    __slots__ = ('institution', 'institution_id', 'institution_prefix', 'exclude', 'oai_url', 'metadata_prefix', 'rules',
+                 'collection', 'record', 'parsed_record', 'header', 'parsed_header', 'metadata', 'parsed_metadata',
+                 'url', 'thumbnail', 'iiif_manifest')
+
     def __init__(self, record, decorators):
         self.institution: str = decorators['institution']
         self.institution_id: str = decorators['institution_id']
         self.institution_prefix: str = decorators['institution_id_prefix']
-        self.exclude: str = decorators['exclude']
+        self.exclude: frozenset = decorators['exclude']
         self.oai_url: str = decorators['oai_url']
         self.metadata_prefix: str = decorators['metadata_prefix']
+        self.rules: rules.MappingRules = decorators['rules'] if 'rules' in decorators else rules.compile(self.institution_id)
+        self.collection: str = None
 
         self.record: BeautifulSoup.element.Tag = record
         self.parsed_record = {}
         self.header: BeautifulSoup.element.Tag = self.set_header()
+        self.check_header()
         self.parsed_header: dict = self.set_parsed_header()
         self.metadata: BeautifulSoup.element.Tag = self.set_metadata()
         self.parsed_metadata: dict = self.set_parsed_metadata()
 
-        self.url: str = self.get_urls()
-        self.thumbnail: str = self.get_urls("thumbnail")
-        self.iiif_manifest: str = self.get_urls("iiif")
+        url, thumbnail, iiif_manifest = self.get_urls()
+        self.url: str = url
+        self.thumbnail: str = thumbnail
+        self.iiif_manifest: str = iiif_manifest
 
     def __bool__(self):
         return type(self.parsed_record) == dict
@@ -33,18 +100,31 @@ class Record:
             raise OAIRecordException('No header in row')
         return self.record.find('header')
 
+    def check_header(self):
+        """
+        Skips records in excluded collections and deleted records by looking only at the raw header's first setSpec
+        and status, before anything in the record is parsed
+        """
+        setspec = self.header.find('setspec')
+        if setspec is not None and setspec.getText().strip() in self.exclude:
+            raise OAIRecordException('Collection excluded from crawl', self.get_identifier())
+        if self.is_deleted() and not self.record.find('metadata'):
+            raise OAIRecordException('Record is deleted', self.get_identifier())
+
+    def get_identifier(self):
+        """
+        Returns the raw header's identifier in the form skip reports keep it, which is all they keep of a skipped record
+        """
+        identifier = self.header.find('identifier')
+        return {'identifier': [identifier.getText().strip()]} if identifier is not None else {}
+
     def set_metadata(self):
         if not self.record.find('metadata'):
-            if self.is_deleted():
-                raise OAIRecordException('Record is deleted')
-            raise OAIRecordException('No metadata in row', self.parsed_header)
+            raise OAIRecordException('No metadata in row', self.get_identifier())
         return self.record.find('metadata').find(self.metadata_prefix)
 
     def set_parsed_header(self):
         self.parsed_record['header'] = self.clean_fields(self.header)
-        if 'setspec' in self.parsed_record['header']:
-            if self.parsed_record['header']['setspec'][0] in self.exclude:
-                raise OAIRecordException('Collection excluded from crawl', self.parsed_record['header'])
         return self.parsed_record['header']
 
     def set_parsed_metadata(self):
@@ -52,58 +132,13 @@ class Record:
         return self.parsed_record['metadata']
 
     def map(self):
-        institution_id = self.institution_id
         dpla_row = dpla_template()
         metadata_map = Template(self)
-        if institution_id == 'frb':
-            metadata = metadata_map.frb()
-        else:
-            if institution_id == "mdh" and "publisher" in self.parsed_metadata:
-                # Rules for Missouri Digital Heritage
-                self.institution = self.parsed_metadata["publisher"][0] + " through Missouri Digital Heritage"
-            elif institution_id == "shsm":
-                # Rules for State Historical Society
-                collection = self.parsed_header["identifier"][0].split(":")[-1].split("/")[0]
-                self.institution_prefix = self.institution_prefix.replace("<collection>", collection)
-            elif institution_id == "slu":
-                # Rules for Saint Louis University
-                collection = self.parsed_header["identifier"][0].split(":")[-1].split("/")[0]
-                if collection == "ong":
-                    self.parsed_metadata["description"] = []
-            elif institution_id == "sgcl":
-                collection = self.parsed_header["identifier"][0].split(":")[-1].split("/")[0]
-                if collection == "p16792coll1":
-                    self.parsed_metadata["rights"] = "The Ozarks Genealogical Society, Inc. offers access to this collection for " \
-                                         "educational and personal research purposes only.  Materials within the collection " \
-                                         "may be protected by the U.S. Copyright Law (Title 17, U.S.C.).  It is the " \
-                                         "researcher's obligation to determine and satisfy copyright or other use restriction " \
-                                         "when publishing or otherwise distributing materials within the collection."
-            elif institution_id == 'grinnell':
-                for k, v in dict(self.parsed_metadata).items():
-                    if len(k.split("_")) > 1 and k.split("_")[1][:4] == 'http':
-                        self.parsed_metadata[k.split("_")[0]] = v
-                        del self.parsed_metadata[k]
-            metadata = Template(self).default()
-
-            if institution_id == 'kcpl1':
-                metadata["sourceResource"]["publisher"] = utils.format_metadata("publisher", self.parsed_metadata)
-            elif institution_id == 'lhl':
-                metadata["sourceResource"]["rights"] = "NO COPYRIGHT - UNITED STATES\nThe organization that has made the Item available believes that the Item is in the Public Domain under the laws of the United States, but a determination was not made as to its copyright status under the copyright laws of other countries. The Item may not be in the Public Domain under the laws of other countries. Please refer to the organization that has made the Item available for more information."
-                metadata["rights"] = "http://rightsstatements.org/vocab/NoC-US/1.0/"
-                metadata["rightsCategory"] = "NO COPYRIGHT - UNITED STATES"
-                metadata["sourceResource"]["format"] = utils.format_metadata("type", self.parsed_metadata, "string")
-                metadata["sourceResource"]["creator"] = utils.format_metadata("contributor", self.parsed_metadata)
-                metadata["@id"] = "missouri--urn:data.mohistory.org:" + self.parsed_header["identifier"][0]
-            elif institution_id == 'isu':
-                metadata["sourceResource"]["rights"] = "CC0"
-                metadata["rights"] = "http://creativecommons.org/publicdomain/zero/1.0/"
-                metadata["sourceResource"]["contributor"] = "Iowa State University. Special Collections and Archives"
-                if "coverage" in self.parsed_metadata.keys():
-                    metadata["sourceResource"]["spatial"] = self.parsed_metadata["coverage"][0]
-                    del metadata["sourceRecord"]["coverage"]
-                if "format" in self.parsed_metadata.keys():
-                    metadata["sourceResource"]["extent"] = self.parsed_metadata["format"][0]
-                    del metadata["sourceResource"]["format"]
+        for rule in self.rules.pre:
+            rule(self)
+        metadata = getattr(metadata_map, self.rules.template)()
+        for rule in self.rules.post:
+            rule(self, metadata)
 
         if not metadata:
             return False
@@ -112,6 +147,14 @@ class Record:
 
         return out_row
 
+    def get_collection(self):
+        """
+        Returns the CONTENTdm collection alias from the record's OAI identifier
+        """
+        if self.collection is None:
+            self.collection = self.parsed_header["identifier"][0].split(":")[-1].split("/")[0]
+        return self.collection
+
     def map_to_dpla(self, metadata, dpla_row):
         """
         Maps institution-specific formatted metadata to a DPLA-formatted record
@@ -122,10 +165,13 @@ class Record:
         """
         dpla_row["isShownAt"] = metadata["url"]
         dpla_row["hasView"]["@id"] = metadata["url"]
-        dpla_row["dataProvider"] = metadata["institution"]
+        dpla_row["dataProvider"] = intern_value(metadata["institution"])
         dpla_row["@id"] = metadata["@id"]
         dpla_row["object"] = metadata["thumbnail"]
-        dpla_row["sourceResource"] = metadata["sourceResource"]
+        dpla_row["sourceResource"] = source_resource = metadata["sourceResource"]
+        for field in INTERNED_FIELDS:
+            if field in source_resource:
+                source_resource[field] = intern_value(source_resource[field])
 
         # Conditional fields, not necessarily in every record
         if "rights" in metadata:
@@ -151,78 +197,129 @@ class Record:
 
     def clean_fields(self, element):
         """
-        Recursive function that parses out nested metadata fields
+        Parses out nested metadata fields in a single pass over the element's descendants, without changing the element.
+        Field names are worked out with get_field_name, which reproduces the names the previous recursive version
+        left on the tree: it renamed elements in place and parsed subjects twice, so elements under a subject
+        had their names processed once more for every subject above them.
 
-        :param element:
-        :return:
+        :param element: header or metadata element
+        :return: dict of field names to lists of values, or a list of values for a leaf element
         """
+        result = self.scan_fields(element, element.name, 1)
+        if type(result) is not Fields:
+            return result
+
+        # Each frame is a Fields whose children still need parsing. Children are parsed depth first and handed
+        # back to their parent's row, so every element is parsed once.
+        stack = [result]
+        while True:
+            frame = stack[-1]
+            if frame.index < len(frame.entries):
+                child, name, passes, repeated, flatten = frame.entries[frame.index]
+                value = self.scan_fields(child, name, passes)
+                if type(value) is Fields:
+                    stack.append(value)
+                    continue
+            else:
+                stack.pop()
+                value = frame.row
+                if not stack:
+                    return value
+                frame = stack[-1]
+                child, name, passes, repeated, flatten = frame.entries[frame.index]
+
+            row = frame.row
+            if repeated:
+                if "titleinfo_" in name:
+                    row[name]["title"].extend(value["title"])
+                else:
+                    row[name].extend(value)
+            elif flatten:
+                row[name] = utils.make_list_flat([v for k, v in value.items()])
+            else:
+                row[name] = value
+            frame.index += 1
 
-        row = {}
-        if not element.findChildren(recursive=False):
+    def scan_fields(self, element, element_name, passes):
+        """
+        Looks at an element's children without parsing them
+
+        :param element: element to parse
+        :param element_name: the element's field name
+        :param passes: number of times the element's children would have been renamed by the recursive version
+        :return: list of values if the element is a leaf or one of its children makes it one, otherwise Fields
+        """
+        children = element.findChildren(recursive=False)
+        if not children:
             return [element.getText().strip()]
-        for el in element.findChildren(recursive=False):
-            # split DC fields to just get the name without the namespace
-            if len(el.name.split(':')) > 1:
-                el.name = el.name.split(':')[1]
 
-            if 'relateditem' in el.name.lower() or 'tableofcontents' in el.name.lower():
+        entries = []
+        seen = set()
+        for el in children:
+            name, compare_name = get_field_name(el.name, el.attrs, passes)
+            if name is None:
                 continue
 
-            if el.attrs:
-                el.name = el.name + "_" + list(el.attrs.values())[0]
-
             # Handle FRASER's weird subject hierarchy
-            if element.name == el.name:
+            if element_name == compare_name:
                 return [el.getText().strip()]
 
-            if element.name == 'name' and el.name == 'namepart':
+            if element_name == 'name' and compare_name == 'namepart':
                 # TODO concatenate namePartDate if it exists
                 return [el.getText()]
 
-            if el.name == "coverage":
-                # Coverage gets "counted" as subject
-                el.name = "subject"
-
             # Handle same field names
-            if el.name in row:
-                if "titleinfo_" in el.name:
-                    row[el.name]["title"].extend(self.clean_fields(el)["title"])
-                else:
-                    row[el.name].extend(self.clean_fields(el))
-            elif el.name == 'subject' and type(self.clean_fields(el)) == dict:
-                row[el.name] = utils.make_list_flat([v for k, v in self.clean_fields(el).items()])
-
+            repeated = name in seen
+            seen.add(name)
+            if not repeated and name == 'subject':
+                # Subjects with subfields are flattened to a list of their values.
+                # Subfield names are worked out one more time than the subject's own, see clean_fields.
+                flatten = not self.is_leaf(el, name, passes * 2 - 1)
+                entries.append((el, name, passes * 2, False, flatten))
             else:
-                row[el.name] = self.clean_fields(el)
+                entries.append((el, name, passes, repeated, False))
 
-        return row
+        return Fields(entries)
 
-    def get_urls(self, type="main"):
-        institution_id = self.institution_id
-        metadata = self.parsed_metadata
-        header = self.parsed_header
-        metadata['institution_id'] = institution_id
-        metadata['header'] = header
+    def is_leaf(self, element, element_name, passes):
+        """
+        Returns whether scan_fields would return a list of values for the element, without parsing its children
+        """
+        children = element.findChildren(recursive=False)
+        if not children:
+            return True
+        for el in children:
+            name, compare_name = get_field_name(el.name, el.attrs, passes)
+            if name is None:
+                continue
+            if element_name == compare_name or (element_name == 'name' and compare_name == 'namepart'):
+                return True
+        return False
 
-        try:
-            url, thumbnail, iiif_manifest = map_list[institution_id](metadata)
-        except KeyError:
-            url, thumbnail, iiif_manifest = False, "", ""
+    def get_urls(self):
+        """
+        Works out the record's URL, thumbnail and IIIF manifest with a single call to the institution's URL function.
+        Institutions without a URL function are reported when their OAI feed is set up, see OAI.__init__.
 
-        if institution_id not in map_list:
+        :return: URL, thumbnail and IIIF manifest
+        """
+        url_function = self.rules.url_function
+        if not url_function:
             # TODO kick off looking for URLs
-            raise OAIRecordException('No mapping found for institution', self.record)
+            raise OAIRecordException('No mapping found for institution', self.get_identifier())
 
-        if type == 'main' and not url:
-            raise OAIRecordException('No URL could be produced for this record', self.record)
+        metadata = self.parsed_metadata
+        metadata['institution_id'] = self.institution_id
+        metadata['header'] = self.parsed_header
+        try:
+            url, thumbnail, iiif_manifest = url_function(metadata)
+        except KeyError:
+            url, thumbnail, iiif_manifest = False, "", ""
 
-        if type == 'thumbnail':
-            return thumbnail
-        elif type == 'iiif':
-            return iiif_manifest
-        else:
-            return url
+        if not url:
+            raise OAIRecordException('No URL could be produced for this record', self.get_identifier())
 
+        return url, thumbnail, iiif_manifest
 
     def check_if_url(self, key, value):
         urls = {}
@@ -0,0 +1,72 @@
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+import random
+
+"""
+    Retry policy for OAI requests. Limits can be set per institution in files/input.json:
+    "retry": {
+        "max_timeouts": // consecutive timeouts or connection errors before the harvest is stopped,
+        "max_server_errors": // consecutive 5xx/429 responses before the harvest is stopped,
+        "backoff": // seconds to wait before the first retry, doubled on each consecutive failure,
+        "max_backoff": // upper bound for any wait, including waits requested through Retry-After,
+        "jitter": // fraction by which each wait is randomly lengthened or shortened
+    }
+"""
+
+# Status codes that mean the server is overloaded or throttling us, rather than that the request is wrong
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+
+
+class RetryPolicy:
+    def __init__(self, max_timeouts=5, max_server_errors=5, backoff=5, max_backoff=300, jitter=0.25):
+        self.max_timeouts: int = max_timeouts
+        self.max_server_errors: int = max_server_errors
+        self.backoff: float = backoff
+        self.max_backoff: float = max_backoff
+        self.jitter: float = jitter
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        :param config: dict of RetryPolicy arguments, e.g. the "retry" object of an institution in files/input.json
+        :return: RetryPolicy
+        """
+        return cls(**(config or {}))
+
+    def should_retry(self, res):
+        return res.status_code in RETRY_STATUS_CODES or res.status_code // 100 == 5
+
+    def get_retry_after(self, res):
+        """
+        Returns the wait requested by the server through a Retry-After header, in seconds
+
+        :param res: requests Response
+        :return: seconds to wait, or None if the server didn't say
+        """
+        value = res.headers.get('Retry-After') if res is not None else None
+        if not value:
+            return None
+        if value.strip().isdigit():
+            return int(value)
+        try:
+            retry_at = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        if retry_at.tzinfo is None:
+            retry_at = retry_at.replace(tzinfo=timezone.utc)
+        return max(0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+    def get_delay(self, attempt, res=None):
+        """
+        Returns how long to wait before the next attempt: the server's Retry-After if given,
+        otherwise exponential backoff with jitter
+
+        :param attempt: number of consecutive failures so far, starting at 1
+        :param res: the failed response, if there was one
+        :return: seconds to wait
+        """
+        retry_after = self.get_retry_after(res)
+        if retry_after is not None:
+            return min(retry_after, self.max_backoff)
+        delay = min(self.backoff * 2 ** (attempt - 1), self.max_backoff)
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
@@ -0,0 +1,238 @@
+import maps
+import utils
+import copy
+
+"""
+    Per-institution mapping rules. Each institution's rules are compiled once, when its OAI feed is set up,
+    into the template to use, its URL function and flat lists of callables, so mapping a record only runs
+    the rules that apply to that institution.
+
+    Rules are set in RULES below and can be added to or overridden per institution with a "rules" object in files/input.json:
+    {
+        "template": // Template method used to map the record, "default" (the default) or "frb",
+        "url": // name of the function in maps.py that returns the record's URL, thumbnail and IIIF manifest,
+        "institution_from_field": // {"field": ..., "suffix": ...} data provider taken from the first value of a field, followed by suffix,
+        "collection_prefix": // if true, <collection> in the @id prefix is replaced with the record's collection,
+        "collection_metadata": // {collection: {field: value}} fields of the parsed metadata replaced for records in a collection,
+        "rename_suffixed_fields": // fields named <field>_<value> where value starts with this string are renamed to <field>,
+        "constants": // {path: value} output fields set to a fixed value, with dotted paths (e.g. "sourceResource.rights"),
+        "fields": // {path: [field, format]} output fields taken from the parsed metadata with utils.format_metadata,
+        "first_values": // [{"field": ..., "to": path, "replaces": path}] output fields set to the first value of a field
+                        // if the record has it, optionally removing another output field,
+        "id_prefix": // if set, the output @id is this prefix followed by the record's OAI identifier
+    }
+"""
+
+OGS_RIGHTS = "The Ozarks Genealogical Society, Inc. offers access to this collection for " \
+             "educational and personal research purposes only.  Materials within the collection " \
+             "may be protected by the U.S. Copyright Law (Title 17, U.S.C.).  It is the " \
+             "researcher's obligation to determine and satisfy copyright or other use restriction " \
+             "when publishing or otherwise distributing materials within the collection."
+
+NOC_US_RIGHTS = "NO COPYRIGHT - UNITED STATES\nThe organization that has made the Item available believes that the Item is in the Public Domain under the laws of the United States, but a determination was not made as to its copyright status under the copyright laws of other countries. The Item may not be in the Public Domain under the laws of other countries. Please refer to the organization that has made the Item available for more information."
+
+RULES = {
+    "frb": {
+        "template": "frb",
+        "url": "frb"
+    },
+    "msu": {"url": "cdm"},
+    "kcpl1": {
+        "url": "kcpl1",
+        "fields": {"sourceResource.publisher": ["publisher", "list"]}
+    },
+    "kcpl2": {"url": "kcpl2"},
+    "umkc": {"url": "um"},
+    "stlpl": {"url": "cdm"},
+    "shsm": {
+        # Rules for State Historical Society
+        "url": "cdm",
+        "collection_prefix": True
+    },
+    "mdh": {
+        # Rules for Missouri Digital Heritage
+        "url": "cdm",
+        "institution_from_field": {"field": "publisher", "suffix": " through Missouri Digital Heritage"}
+    },
+    "slu": {
+        # Rules for Saint Louis University
+        "url": "cdm",
+        "collection_metadata": {"ong": {"description": []}}
+    },
+    "umsl": {"url": "um"},
+    "sgcl": {
+        "url": "cdm",
+        "collection_metadata": {"p16792coll1": {"rights": OGS_RIGHTS}}
+    },
+    "wustl1": {"url": "wustl1"},
+    "wustl2": {"url": "wustl2"},
+    "lhl": {
+        "url": "lhl",
+        "constants": {
+            "sourceResource.rights": NOC_US_RIGHTS,
+            "rights": "http://rightsstatements.org/vocab/NoC-US/1.0/",
+            "rightsCategory": "NO COPYRIGHT - UNITED STATES"
+        },
+        "fields": {
+            "sourceResource.format": ["type", "string"],
+            "sourceResource.creator": ["contributor", "list"]
+        },
+        "id_prefix": "missouri--urn:data.mohistory.org:"
+    },
+    "drake": {"url": "cdm"},
+    "grinnell": {
+        "url": "grinnell",
+        "rename_suffixed_fields": "http"
+    },
+    "uni": {"url": "uni"},
+    "isu": {
+        "url": "isu",
+        "constants": {
+            "sourceResource.rights": "CC0",
+            "rights": "http://creativecommons.org/publicdomain/zero/1.0/",
+            "sourceResource.contributor": "Iowa State University. Special Collections and Archives"
+        },
+        "first_values": [
+            {"field": "coverage", "to": "sourceResource.spatial"},
+            {"field": "format", "to": "sourceResource.extent", "replaces": "sourceResource.format"}
+        ]
+    }
+}
+
+compiled = {}
+
+
+class MappingRules:
+    def __init__(self, template="default", url_function=None, pre=None, post=None):
+        # Name of the Template method that maps the record
+        self.template: str = template
+        # Function from maps.py, or None if the institution has no mapping
+        self.url_function = url_function
+        # Rules run on the Record before the template, and on the template's output after it
+        self.pre: list = pre or []
+        self.post: list = post or []
+
+
+def get_rules(id, overrides=None):
+    rules = dict(RULES.get(id, {}))
+    rules.update(overrides or {})
+    return rules
+
+
+def compile(id, overrides=None):
+    """
+    Compiles an institution's rules. Institutions without overrides share one compiled set of rules.
+
+    :param id: institution id
+    :param overrides: rules from the institution's "rules" object in files/input.json
+    :return: MappingRules
+    """
+    if not overrides and id in compiled:
+        return compiled[id]
+
+    rules = get_rules(id, overrides)
+    pre = []
+    post = []
+
+    if "institution_from_field" in rules:
+        pre.append(institution_from_field(**rules["institution_from_field"]))
+    if rules.get("collection_prefix"):
+        pre.append(collection_prefix())
+    if "collection_metadata" in rules:
+        pre.append(collection_metadata(rules["collection_metadata"]))
+    if "rename_suffixed_fields" in rules:
+        pre.append(rename_suffixed_fields(rules["rename_suffixed_fields"]))
+
+    if "constants" in rules:
+        post.append(constants(rules["constants"]))
+    if "fields" in rules:
+        post.append(fields(rules["fields"]))
+    if "first_values" in rules:
+        post.append(first_values(rules["first_values"]))
+    if "id_prefix" in rules:
+        post.append(id_prefix(rules["id_prefix"]))
+
+    url_function = getattr(maps, rules["url"]) if "url" in rules else None
+    mapping_rules = MappingRules(rules.get("template", "default"), url_function, pre, post)
+    if not overrides:
+        compiled[id] = mapping_rules
+    return mapping_rules
+
+
+def split_path(path):
+    keys = path.split(".")
+    return keys[:-1], keys[-1]
+
+
+def get_parent(metadata, keys):
+    for key in keys:
+        metadata = metadata[key]
+    return metadata
+
+
+def institution_from_field(field, suffix=""):
+    def rule(record):
+        if field in record.parsed_metadata:
+            record.institution = record.parsed_metadata[field][0] + suffix
+    return rule
+
+
+def collection_prefix():
+    def rule(record):
+        record.institution_prefix = record.institution_prefix.replace("<collection>", record.get_collection())
+    return rule
+
+
+def collection_metadata(collections):
+    def rule(record):
+        collection = record.get_collection()
+        if collection in collections:
+            record.parsed_metadata.update(copy.deepcopy(collections[collection]))
+    return rule
+
+
+def rename_suffixed_fields(prefix):
+    def rule(record):
+        for k, v in dict(record.parsed_metadata).items():
+            if len(k.split("_")) > 1 and k.split("_")[1].startswith(prefix):
+                record.parsed_metadata[k.split("_")[0]] = v
+                del record.parsed_metadata[k]
+    return rule
+
+
+def constants(values):
+    paths = [(split_path(path), value) for path, value in values.items()]
+
+    def rule(record, metadata):
+        for (keys, key), value in paths:
+            get_parent(metadata, keys)[key] = value
+    return rule
+
+
+def fields(values):
+    paths = [(split_path(path), field, return_format) for path, (field, return_format) in values.items()]
+
+    def rule(record, metadata):
+        for (keys, key), field, return_format in paths:
+            get_parent(metadata, keys)[key] = utils.format_metadata(field, record.parsed_metadata, return_format)
+    return rule
+
+
+def first_values(values):
+    paths = [(value["field"], split_path(value["to"]), split_path(value["replaces"]) if "replaces" in value else None)
+             for value in values]
+
+    def rule(record, metadata):
+        for field, (keys, key), replaces in paths:
+            if field not in record.parsed_metadata:
+                continue
+            get_parent(metadata, keys)[key] = record.parsed_metadata[field][0]
+            if replaces:
+                get_parent(metadata, replaces[0]).pop(replaces[1], None)
+    return rule
+
+
+def id_prefix(prefix):
+    def rule(record, metadata):
+        metadata["@id"] = prefix + record.parsed_header["identifier"][0]
+    return rule
@@ -0,0 +1,152 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib.parse import urlparse
+from contextlib import contextmanager
+import threading
+
+"""
+    Shared HTTP session used for every network request in the pipeline.
+    Connections are pooled per host and kept alive between requests, so a feed with thousands of resumption pages
+    only pays for a TCP/TLS handshake once per pooled connection instead of once per page.
+"""
+
+# (connect, read) timeout in seconds, used when a request doesn't set its own
+DEFAULT_TIMEOUT = (10, 30)
+# Number of connections kept open per host
+POOL_MAXSIZE = 10
+# Concurrent crawls share the same hosts (e.g. several CONTENTdm instances), so requests are capped per host
+MAX_REQUESTS_PER_HOST = 2
+
+host_semaphores = {}
+host_semaphores_lock = threading.Lock()
+stats = {}
+stats_lock = threading.Lock()
+_session = None
+_session_lock = threading.Lock()
+
+
+def add_stat(host, key, value=1):
+    with stats_lock:
+        if host not in stats:
+            stats[host] = {"requests": 0, "handshakes": 0, "bytes_wire": 0, "bytes_decoded": 0}
+        stats[host][key] += value
+
+
+class CountingHTTPConnection(HTTPConnection):
+    def connect(self):
+        add_stat(self.host, "handshakes")
+        return super().connect()
+
+
+class CountingHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        add_stat(self.host, "handshakes")
+        return super().connect()
+
+
+class CountingHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = CountingHTTPConnection
+
+
+class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = CountingHTTPSConnection
+
+
+class PooledAdapter(HTTPAdapter):
+    """
+    HTTPAdapter whose connection pools count every new TCP/TLS connection they open
+    """
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": CountingHTTPConnectionPool,
+            "https": CountingHTTPSConnectionPool
+        }
+
+
+def configure(timeout=None, pool_maxsize=None, max_requests_per_host=None):
+    """
+    Changes session settings. Must be called before any requests are sent, since pools and semaphores are created on first use.
+
+    :param timeout: default (connect, read) timeout, or a single number used for both
+    :param pool_maxsize: number of connections kept open per host
+    :param max_requests_per_host: maximum concurrent requests to a single host
+    """
+    global DEFAULT_TIMEOUT, POOL_MAXSIZE, MAX_REQUESTS_PER_HOST, _session
+    if timeout:
+        DEFAULT_TIMEOUT = timeout
+    if pool_maxsize:
+        POOL_MAXSIZE = int(pool_maxsize)
+    if max_requests_per_host:
+        MAX_REQUESTS_PER_HOST = max(1, int(max_requests_per_host))
+    with _session_lock:
+        _session = None
+
+
+def get_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            new_session = requests.Session()
+            adapter = PooledAdapter(pool_connections=20, pool_maxsize=max(POOL_MAXSIZE, MAX_REQUESTS_PER_HOST))
+            new_session.mount("http://", adapter)
+            new_session.mount("https://", adapter)
+            new_session.headers.update({
+                "Accept-Encoding": "gzip, deflate",
+                "Connection": "keep-alive"
+            })
+            _session = new_session
+        return _session
+
+
+@contextmanager
+def host_slot(url):
+    """
+    Context manager that blocks until a request slot is free for the host in the given URL.
+
+    :param url: URL about to be requested
+    """
+    host = urlparse(url).netloc
+    with host_semaphores_lock:
+        if host not in host_semaphores:
+            host_semaphores[host] = threading.BoundedSemaphore(MAX_REQUESTS_PER_HOST)
+        semaphore = host_semaphores[host]
+    with semaphore:
+        yield
+
+
+def get(url, params=None, timeout=None, **kwargs):
+    """
+    Sends a GET request through the shared session, respecting the per-host request limit.
+
+    :param url: URL to request
+    :param params: query parameters
+    :param timeout: overrides DEFAULT_TIMEOUT
+    :return: requests Response object, with its body already read
+    """
+    with host_slot(url):
+        res = get_session().get(url, params=params, timeout=timeout or DEFAULT_TIMEOUT, **kwargs)
+        content = res.content
+
+    host = urlparse(res.url).hostname
+    add_stat(host, "requests")
+    add_stat(host, "bytes_wire", res.raw.tell() if res.raw else len(content))
+    add_stat(host, "bytes_decoded", len(content))
+
+    return res
+
+
+def report():
+    """
+    Prints request, handshake and transfer counts per host
+    """
+    with stats_lock:
+        rows = sorted(stats.items())
+    if not rows:
+        return
+    print("\nHTTP usage:")
+    for host, row in rows:
+        print(f"   - {host}: {row['requests']} requests, {row['handshakes']} handshakes, "
+              f"{row['bytes_wire'] / 1e6:.2f} MB on the wire ({row['bytes_decoded'] / 1e6:.2f} MB decoded)")
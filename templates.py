@@ -1,4 +1,5 @@
-from utils import format_metadata
+from utils import FieldMemo
+from dates import get_temporal
 
 
 class Template:
@@ -9,34 +10,35 @@ class Template:
         self.url = record.url
         self.thumbnail = record.thumbnail
         self.iiif_manifest = record.iiif_manifest
+        # Field values are read once per record, however many output fields use them
+        self.fields = FieldMemo(self.metadata)
+        self.header_fields = FieldMemo(self.header)
 
     def default(self):
         record = self.record
-        metadata = self.metadata
-        header = self.header
+        fields = self.fields
+        identifier = self.header_fields.format("identifier", "string")
 
         metadata = {
             "url": self.url,
             "institution": self.record.institution,
             "thumbnail": self.thumbnail,
             "sourceResource": {
-                "title": format_metadata("title", metadata),
-                "description": format_metadata("description", metadata),
-                "subject": format_metadata("subject", metadata),
+                "title": fields.format("title"),
+                "description": fields.format("description"),
+                "subject": fields.format("subject"),
                 "temporal": [
-                    {
-                        "displayDate": format_metadata("date", metadata, "string")  # TODO: Parse start/end dates
-                    }
+                    get_temporal(fields.format("date", "string"))
                 ],
                 "identifier": [record.url],
-                "creator": format_metadata("creator", metadata),
-                "language": format_metadata("language", metadata),
-                "rights": format_metadata("rights", metadata, "string"),
-                "@id": format_metadata("identifier", header, "string"),
-                "format": format_metadata("format", metadata, "string")
+                "creator": fields.format("creator"),
+                "language": fields.format("language"),
+                "rights": fields.format("rights", "string"),
+                "@id": identifier,
+                "format": fields.format("format", "string")
             },
             # ID Prefix = {hub_id}--{institution_id}:oai:{oai_url}
-            "@id": self.record.institution_prefix + ":" + format_metadata("identifier", header, "string").split(":")[-1]
+            "@id": self.record.institution_prefix + ":" + identifier.split(":")[-1]
         }
 
         if self.iiif_manifest:
@@ -46,43 +48,49 @@ class Template:
 
     def frb(self):
         record = self.record
-        metadata = self.metadata
-        header = self.header
+        fields = self.fields
+        identifier = self.header_fields.format("identifier", "string")
+        date_issued = fields.format("origininfo.dateissued", "string")
+        date_start = fields.format("origininfo.dateissued_start", "string")
+        date_end = fields.format("origininfo.dateissued_end", "string")
 
         metadata = {
             "url": self.url,
             "institution": record.institution,
             "thumbnail": record.thumbnail,
             "sourceResource": {
-                "title": format_metadata("titleinfo.title", metadata),
-                "description": format_metadata("abstract", metadata),
-                "subject": format_metadata("subject", metadata),
+                "title": fields.format("titleinfo.title"),
+                "description": fields.format("abstract"),
+                "subject": fields.format("subject"),
                 "temporal": [{
-                    "start": format_metadata("origininfo.dateissued_start", metadata, "string"),
-                    "end": format_metadata("origininfo.dateissued_end", metadata, "string"),
-                    "displayDate": format_metadata("origininfo.dateissued_start", metadata,
-                                                   "string") + "/" + format_metadata("origininfo.dateissued_end",
-                                                                                     metadata,
-                                                                                     "string") if not format_metadata(
-                        "origininfo.dateissued", metadata, "string") else format_metadata("origininfo.dateissued",
-                                                                                          metadata, "string")
+                    "start": date_start,
+                    "end": date_end,
+                    "displayDate": date_start + "/" + date_end if not date_issued else date_issued
                 }],
                 "identifier": record.url,
-                "creator": format_metadata("name", metadata),
-                "language": format_metadata("language", metadata),
-                "rights": format_metadata("accesscondition", metadata, "string"),
-                "@id": format_metadata("identifier", header, "string"),
-                "format": format_metadata("genre", metadata, "string")
+                "creator": fields.format("name"),
+                "language": fields.format("language"),
+                "rights": fields.format("accesscondition", "string"),
+                "@id": identifier,
+                "format": fields.format("genre", "string")
             },
-            "@id": record.institution_prefix + ":" + format_metadata("identifier", header, "string").split(":")[-1]
+            "@id": record.institution_prefix + ":" + identifier.split(":")[-1]
         }
 
         return metadata
 
 
+# Sub-objects that are the same in every record. Rows refer to these rather than copies, so each is only written out
+# per record when the rows are serialised. They're shared, so never change them through a row.
+PROVIDER = {
+    "@id": "http://dp.la/api/contributor/missouri-hub",
+    "name": "Missouri Hub"
+}
+
+
 def dpla_template():
     """
-    Default record template for DPLA records
+    Default record template for DPLA records. sourceResource is set from the institution template's output.
 
     :return:
     """
@@ -94,35 +102,10 @@ def dpla_template():
         "hasView": {
             "@id": None  # URL to object
         },
-        "provider": {
-            "@id": "http://dp.la/api/contributor/missouri-hub",
-            "name": "Missouri Hub"
-        },
+        "provider": PROVIDER,
         "object": None,  # thumbnail
         "aggregatedCHO": "#sourceResource",
-        "sourceResource": {
-            "title": [],
-            "description": [],
-            "subject": [],
-            "temporal": [],
-            "rights": "",
-            "@id": "",  # OAI ID
-            "language": [
-                {
-                    "iso639_3": "eng",
-                    "name": "English"
-                }
-            ],
-            "stateLocatedIn": [
-                {
-                    "name": "Missouri"
-                }
-            ],
-            "format": "",
-            "identifier": [],
-            "creator": [],
-            "specType": []
-        },
+        "sourceResource": None,
         "@id": ""
     }
 
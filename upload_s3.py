@@ -1,23 +1,247 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import argparse
+import base64
 import boto3
+import botocore.exceptions
+import hashlib
+import json
 import os
-import progressbar
-from datetime import datetime
+import threading
+import time
+
+"""
+    Multipart uploads to S3. A file is sent in parts of PART_SIZE bytes, CONCURRENCY of them at a time, and can be
+    uploaded while it's still being written: MultipartUpload takes bytes as they're produced and sends each part as soon
+    as it's full, which is how ingest.compile uploads the ingest file as it compiles it (see utils.compile).
+
+    Each part is sent with its MD5 checksum, which S3 checks the part against. Finished parts are recorded with their
+    checksums in a state file next to the local file ({file}.upload.json), so an interrupted upload is picked up where
+    it stopped: parts S3 already has with the same checksum aren't sent again.
+
+    The bucket comes from S3_BUCKET and credentials from AWS_ACCESS_KEY and AWS_SECRET_KEY. S3_ENDPOINT_URL, or
+    endpoint_url, points uploads at another S3-compatible service, e.g. a local moto server for testing.
+"""
+
+# Size of each part of a multipart upload. S3 needs parts of at least 5 MiB, except the last one
+PART_SIZE = 16 * 1024 * 1024
+MIN_PART_SIZE = 5 * 1024 * 1024
+# Number of parts sent at the same time. As many parts again can be waiting in memory to be sent.
+CONCURRENCY = 4
+# Suffix of the state file kept next to a file while it's being uploaded
+STATE_SUFFIX = '.upload.json'
+MB = 1024 * 1024
+
 
-def upload_s3(fpath):
-    fn = fpath.split("/")[-1]
-    client = boto3.client('s3',
+def get_client(endpoint_url=None):
+    return boto3.client('s3',
         aws_access_key_id=os.getenv('AWS_ACCESS_KEY'),
-        aws_secret_access_key=os.getenv('AWS_SECRET_KEY')
+        aws_secret_access_key=os.getenv('AWS_SECRET_KEY'),
+        endpoint_url=endpoint_url or os.getenv('S3_ENDPOINT_URL')
     )
-    statinfo = os.stat(fpath)
-    up_progress = progressbar.progressbar.ProgressBar(maxval=statinfo.st_size)
-    up_progress.start()
-    def upload_progress(chunk):
-        up_progress.update(up_progress.currval + chunk)
+
+
+def get_key(fpath):
     now = datetime.now().strftime("%Y%m%d")
-    print("starting upload...")
-    res = client.upload_file(fpath, os.getenv('S3_BUCKET'), f"{now}/{fn}", Callback=upload_progress)
-    up_progress.finish()
-    print(f"finished upload to {now}/{fn}")
+    return f"{now}/{os.path.basename(fpath)}"
+
+
+class MultipartUpload:
+    """
+    Upload of a single object, written to like a binary file. Parts are sent in the background as soon as they're
+    full, and close() sends the last one and completes the upload.
+    """
+
+    def __init__(self, client, bucket, key, state_path, part_size=PART_SIZE, concurrency=CONCURRENCY):
+        """
+        :param client: boto3 S3 client
+        :param bucket: bucket name
+        :param key: object key, unless an unfinished upload is resumed from the state file, which keeps its own key
+        :param state_path: path to the state file
+        :param part_size: size in bytes of each part
+        :param concurrency: number of parts sent at the same time
+        """
+        if part_size < MIN_PART_SIZE:
+            raise ValueError(f"Parts need to be at least {MIN_PART_SIZE // MB} MB")
+        self.client = client
+        self.bucket: str = bucket
+        self.key: str = key
+        self.state_path: str = state_path
+        self.part_size: int = part_size
+        self.upload_id: str = None
+        # Part number to {"PartNumber", "ETag"} of each part S3 has. The ETag is only the part's MD5 checksum on buckets
+        # without SSE-KMS or SSE-C encryption, so the checksums are kept separately
+        self.parts: dict = {}
+        # Part number to the MD5 hex digest of each part S3 has
+        self.checksums: dict = {}
+        self.buffer = bytearray()
+        self.part_count: int = 0
+        self.size: int = 0
+        self.sent: int = 0
+        self.lock = threading.Lock()
+        # Bounds the parts waiting to be sent or being sent, which are all held in memory
+        self.slots = threading.BoundedSemaphore(concurrency * 2)
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.futures: list = []
+        self.start_time: float = time.time()
+        self.start()
+
+    def start(self):
+        """
+        Resumes the upload in the state file if S3 still has it, otherwise starts a new one
+        """
+        state = None
+        if os.path.exists(self.state_path):
+            with open(self.state_path, "r") as inf:
+                state = json.load(inf)
+        if state and state['bucket'] == self.bucket and state['part_size'] == self.part_size:
+            try:
+                listed = {}
+                paginator = self.client.get_paginator('list_parts')
+                for page in paginator.paginate(Bucket=self.bucket, Key=state['key'], UploadId=state['upload_id']):
+                    for part in page.get('Parts', []):
+                        listed[part['PartNumber']] = part['ETag']
+            except botocore.exceptions.ClientError as e:
+                if e.response['Error']['Code'] != 'NoSuchUpload':
+                    raise
+                print(f"Upload of {state['key']} can't be resumed, starting again.")
+            else:
+                self.key = state['key']
+                self.upload_id = state['upload_id']
+                # Parts that were sent but that S3 doesn't list, or lists with another checksum, are sent again
+                self.parts = {
+                    part['PartNumber']: part for part in state['parts']
+                    if listed.get(part['PartNumber']) == part['ETag']
+                }
+                # JSON keys are strings. Parts without a recorded checksum are sent again
+                checksums = state['checksums'] if 'checksums' in state else {}
+                self.checksums = {
+                    int(number): checksum for number, checksum in checksums.items() if int(number) in self.parts
+                }
+                print(f"Resuming upload of {self.key}, {len(self.parts)} parts already uploaded.")
+                return
+        response = self.client.create_multipart_upload(Bucket=self.bucket, Key=self.key)
+        self.upload_id = response['UploadId']
+        self.save_state()
+
+    def save_state(self):
+        tmp_path = f"{self.state_path}.tmp"
+        with open(tmp_path, "w") as outf:
+            json.dump({
+                "bucket": self.bucket,
+                "key": self.key,
+                "upload_id": self.upload_id,
+                "part_size": self.part_size,
+                "parts": sorted(self.parts.values(), key=lambda part: part['PartNumber']),
+                "checksums": self.checksums
+            }, outf)
+        os.replace(tmp_path, self.state_path)
+
+    def write(self, data):
+        self.buffer += data
+        self.size += len(data)
+        while len(self.buffer) >= self.part_size:
+            self.send(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+        return len(data)
+
+    def send(self, data):
+        """
+        Queues the next part to be sent, unless S3 already has it from an interrupted upload
+        """
+        self.part_count += 1
+        md5 = hashlib.md5(data)
+        if self.checksums.get(self.part_count) == md5.hexdigest():
+            return
+        self.slots.acquire()
+        future = self.executor.submit(self.send_part, self.part_count, data, md5)
+        future.add_done_callback(lambda f: self.slots.release())
+        self.futures.append(future)
+
+    def send_part(self, part_number, data, md5):
+        response = self.client.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=part_number, Body=data,
+            ContentMD5=base64.b64encode(md5.digest()).decode("ascii")
+        )
+        # S3 rejects a part that doesn't match ContentMD5, so whatever ETag it returns is kept
+        with self.lock:
+            self.parts[part_number] = {"PartNumber": part_number, "ETag": response['ETag']}
+            self.checksums[part_number] = md5.hexdigest()
+            self.sent += len(data)
+            self.save_state()
+            elapsed = time.time() - self.start_time
+            print(f"{self.key}: part {part_number} uploaded, {self.sent / MB:.1f} MB at {self.sent / MB / elapsed:.1f} MB/s")
+
+    def close(self):
+        """
+        Sends the last part, waits for every part to be sent and completes the upload
+
+        :return: number of bytes uploaded, elapsed seconds and MB/s
+        """
+        if self.buffer or not self.part_count:
+            self.send(bytes(self.buffer))
+            self.buffer.clear()
+        try:
+            for future in self.futures:
+                future.result()
+        finally:
+            self.executor.shutdown()
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            MultipartUpload={"Parts": [self.parts[number] for number in range(1, self.part_count + 1)]}
+        )
+        os.remove(self.state_path)
+
+        elapsed = time.time() - self.start_time
+        rate = self.sent / MB / elapsed if elapsed else 0
+        print(f"Finished upload to {self.key}: {self.size / MB:.1f} MB, {self.sent / MB:.1f} MB sent in {elapsed:.1f}s ({rate:.1f} MB/s)")
+        return self.sent, elapsed, rate
+
+
+def start_upload(fpath, part_size=PART_SIZE, concurrency=CONCURRENCY, endpoint_url=None, client=None):
+    """
+    Starts uploading a file, or resumes its interrupted upload, before it's written. Its bytes are written
+    to the returned MultipartUpload as they're written to the file.
+
+    :param fpath: path the file is being written to, which names the object and the state file
+    :param part_size: size in bytes of each part
+    :param concurrency: number of parts sent at the same time
+    :param endpoint_url: S3 endpoint, if not AWS or S3_ENDPOINT_URL
+    :param client: boto3 S3 client, if not made from the environment
+    :return: MultipartUpload
+    """
+    return MultipartUpload(client or get_client(endpoint_url), os.getenv('S3_BUCKET'), get_key(fpath),
+                           fpath + STATE_SUFFIX, part_size, concurrency)
+
+
+def upload_s3(fpath, part_size=PART_SIZE, concurrency=CONCURRENCY, endpoint_url=None, client=None):
+    """
+    Uploads a finished file, resuming its interrupted upload if there is one
+
+    :param fpath: path to the file
+    :return: number of bytes uploaded, elapsed seconds and MB/s
+    """
+    print(f"starting upload of {fpath}...")
+    upload = start_upload(fpath, part_size, concurrency, endpoint_url, client)
+    with open(fpath, "rb") as inf:
+        while True:
+            chunk = inf.read(part_size)
+            if not chunk:
+                break
+            upload.write(chunk)
+    return upload.close()
+
 
-upload_s3("mohub_ingest.jsonl")
\ No newline at end of file
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Upload files to S3 as concurrent multipart uploads')
+    parser.add_argument('files', nargs='*', default=["mohub_ingest.jsonl"],
+                        help="Files to upload.")
+    parser.add_argument('--part_mb', '-pm', type=int, default=PART_SIZE // MB,
+                        help="Size of each part in MB, at least 5.")
+    parser.add_argument('--concurrency', '-c', type=int, default=CONCURRENCY,
+                        help="Number of parts uploaded at the same time.")
+    parser.add_argument('--endpoint_url', '-e', default=None,
+                        help="S3 endpoint to upload to instead of AWS, e.g. a local moto server. Defaults to S3_ENDPOINT_URL.")
+    args = parser.parse_args()
+    for fpath in args.files:
+        upload_s3(fpath, args.part_mb * MB, args.concurrency, args.endpoint_url)
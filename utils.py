@@ -1,124 +1,400 @@
-from dateutil import parser
 import pandas as pd
-import requests
 import json
 from glob import glob
 from datetime import datetime, timedelta
+from functools import lru_cache
 import os
+import shutil
 import institutions
 from iso639 import languages
 from urllib.parse import urlparse
-import progressbar
-import boto3
+from upload_s3 import upload_s3, start_upload
 from dotenv import load_dotenv
-import zipfile
+import threading
+import session
+import dates
+import ingest
 
 load_dotenv()
 import sys
 
 DATA_DIR = './files/institutions'
 REPORTS_DIR = './files/reports'
+HARVEST_STATE_FILE = './files/harvest_state.json'
+CHECKPOINTS_DIR = './files/checkpoints'
+# Code types languages are matched on after their name, in order
+LANGUAGE_CODES = ['part3', 'part2b', 'part2t', 'part1']
+# Number of distinct language values whose matches are kept in memory
+LANGUAGE_CACHE_SIZE = 4096
+# Number of distinct field values whose split parts are kept in memory
+VALUE_CACHE_SIZE = 8192
+# Number of CONTENTdm collection URLs whose base URL and collection alias are kept in memory
+CDM_CACHE_SIZE = 1024
+CDM_THUMBNAIL = "{}/utils/getthumbnail/collection/{}/id/{}"
+CDM_IIIF_MANIFEST = "{}/iiif/info/{}/{}/manifest.json"
+# Suffix of the summary file written next to a streamed {id}.jsonl output file
+SUMMARY_SUFFIX = ingest.SUMMARY_SUFFIX
+harvest_state_lock = threading.Lock()
 
 
 def get_data_files():
     institutions_data = institutions.get()
     files = []
     for institution in institutions_data:
-        files.extend(glob(f"{DATA_DIR}/{institution.id}.json"))
+        path = find_data_file(institution.id, [DATA_DIR])
+        if path:
+            files.append(path)
     return files
 
-def upload_s3(fpath):
-    fn = fpath.split("/")[-1]
-    client = boto3.client('s3',
-        aws_access_key_id=os.getenv('AWS_ACCESS_KEY'),
-        aws_secret_access_key=os.getenv('AWS_SECRET_KEY')
-    )
-    statinfo = os.stat(fpath)
-    up_progress = progressbar.progressbar.ProgressBar(maxval=statinfo.st_size)
-    up_progress.start()
-    def upload_progress(chunk):
-        up_progress.update(up_progress.currval + chunk)
-    now = datetime.now().strftime("%Y%m%d")
-    print("starting upload...")
-    res = client.upload_file(fpath, os.getenv('S3_BUCKET'), f"{now}/{fn}", Callback=upload_progress)
-    up_progress.finish()
-    print(f"finished upload to {now}/{fn}")
+
+def find_data_file(id, dirs=None):
+    """
+    Returns the path to an institution's output file, streamed JSONL output taking precedence over a JSON file,
+    and uncompressed files over compressed ones
+
+    :param id: institution id
+    :param dirs: directories to look in, in order, defaults to the working directory write_file and JSONLWriter write to
+    :return: path, or None if the institution has no output file
+    """
+    for directory in dirs or ["."]:
+        for ext in ["jsonl", "json"]:
+            for suffix in [""] + list(ingest.COMPRESSIONS.values()):
+                path = f"{directory}/{id}.{ext}{suffix}"
+                if os.path.exists(path):
+                    return path
+    return None
+
+
+def is_jsonl(path):
+    return ingest.strip_compression(path).endswith(".jsonl")
+
+
+def get_summary_path(path):
+    return ingest.strip_compression(path)[:-len(".jsonl")] + SUMMARY_SUFFIX
+
+
+def read_summary(path):
+    """
+    Returns everything in an output file except its records
+
+    :param path: path to an output file written by write_file or JSONLWriter
+    :return: dict with institution, count, skipped and retries
+    """
+    if is_jsonl(path):
+        with open(get_summary_path(path), "r") as inf:
+            return json.load(inf)
+    with ingest.open_input(path) as inf:
+        return ingest.read_json_summary(inf)
+
+
+def iter_records(path):
+    """
+    Yields the records in an output file one at a time. JSONL files are read a line at a time
+    and JSON files with an incremental parser, see ingest.py.
+
+    :param path: path to an output file written by write_file or JSONLWriter
+    """
+    yield from ingest.iter_records(path)
+
+
+def read_data_file(path):
+    """
+    Reads an output file into the structure write_file produces, whether it was written as a single JSON object
+    or streamed as JSONL with a summary file, and compressed or not, so consumers don't need to know which
+
+    :param path: path to an output file
+    :return: dict with institution, count, skipped, retries and records
+    """
+    if is_jsonl(path):
+        data = read_summary(path)
+        data['records'] = list(iter_records(path))
+        return data
+    with ingest.open_input(path) as inf:
+        return json.load(inf)
 
 
-def compile(upload):
+def compile(upload, compression=None, part_size=None, previous_hashes=None):
     """
     Compiles all crawled files into one JSONL file to send off to DPLA
 
+    :param upload: if set, the ingest file, or each of its parts, and the manifest are uploaded to S3 as they're written
+    :param compression: None, gzip or zstd
+    :param part_size: if set, the ingest file is split into part files of about this many bytes
+    :param previous_hashes: if set, path to the previous delivery's hashes file, which the added, changed and deleted
+        records are worked out against
     :return:
     """
-    # TODO: Upload compiled file to S3 directly
     data_files = glob("*_data.zip")
     if len(data_files) < 1:
         raise Exception("No files found to compile!")
     print("Compiling...")
     datetimestr = datetime.now().strftime("%Y%m%d%H%M%S")
-    out = []
-    for file in data_files:
-        print(file)
-        with zipfile.ZipFile(file, "r") as zip_ref:
-            zip_ref.extractall("./")
-        json_file = file.replace(".zip", ".json")
-        with open(json_file, "r") as inf:
-            data = json.load(inf)
-        out.extend(data['records'])
-        inf.close()
     outfn = "mohub_ingest.json"
     outfn_l = f"{outfn}l"
     # with open(outfn, "w") as outf:
     #     json.dump(out, outf, indent=4)
-    # finish by writing to jsonl, as DPLA prefers
-    with open(outfn_l, "w") as outf:
-        for line in out:
-            json.dump(line, outf)
-            outf.write('\n')
-    write_report(datetimestr)
-    print("Total: {}".format(len(out)))
-    print("Wrote ingest file to {}".format(outfn))
-    if upload:
-        upload_s3(outfn_l)
-
-
-def write_report(datetimestr):
+    # Records are read straight out of each zip and written to jsonl, as DPLA prefers, one at a time
+    manifest, collisions = ingest.compile(data_files, outfn_l, compression=compression, part_size=part_size,
+                                          upload=start_upload if upload else None, previous_hashes=previous_hashes)
+    write_report(datetimestr, collisions)
+    print("Total: {}".format(manifest['count']))
+    print("Wrote ingest file to {}".format(", ".join(part['path'] for part in manifest['parts'])))
+
+
+def write_report(datetimestr, collisions=None):
     json_files = get_data_files()
     with open(f"{REPORTS_DIR}/report_{datetimestr}.txt", "w") as outf:
         for file in json_files:
-            with open(file, 'r') as inf:
-                data = json.load(inf)
+            data = read_summary(file)
             skipped = data['skipped']
             count = data['count']
             name = data['institution']
             outf.write(f"# {name}\n")
             outf.write(f"   - {count} records added\n")
             outf.write(f"   - {skipped} records skipped\n\n")
+            if data.get('retries'):
+                retries = data['retries']
+                outf.write(f"   - {retries.get('timeouts', 0)} timeouts and {retries.get('server_errors', 0)} server errors retried\n\n")
             for reason, records in data['skipped_errors'].items():
                 outf.write(f"       - {reason}: {count(records)}\n\n")
-            inf.close()
+        if collisions:
+            outf.write("# Duplicate @ids left out of the ingest file\n")
+            for line in ingest.get_collision_lines(collisions):
+                outf.write(f"   - {line}\n")
 
 
-def write_file(out_path, metadata, id, name, skipped, skipped_records):
+def get_skipped_record_report(skipped_records):
     skipped_record_report = {}
     for reason, skipped_record_list in skipped_records.items():
         skipped_count = len(skipped_record_list)
         skipped_record_report[reason] = {}
         skipped_record_report[reason]['count'] = skipped_count
         skipped_record_report[reason]['records'] = [record for record in skipped_record_list if record]
+    return skipped_record_report
+
+
+def write_file(out_path, metadata, id, name, skipped, skipped_records, retries=None, compression=None):
+    skipped_record_report = get_skipped_record_report(skipped_records)
 
     out_data = {
         "institution": name,
         "count": len(metadata),
         "skipped": skipped,
+        "retries": retries or {},
         "records": metadata
     }
     out_path = out_path if out_path[-1] == '/' else out_path + '/'
-    with open("{}.json".format(id), "w") as outf:
+    path = ingest.get_compressed_path("{}.json".format(id), compression)
+    with ingest.open_output(path, compression) as outf:
         json.dump(out_data, outf, indent=4)
+    ingest.remove_other_compressions(path)
+
+    print(f"\n{len(metadata)} records written to {path}")
+
+
+class JSONLWriter:
+    """
+    Writes an institution's records to {id}.jsonl as they're harvested, one record per line, so that memory use doesn't grow
+    with the size of the feed. Records go to a temporary file that only replaces {id}.jsonl once the harvest is finished,
+    along with a summary file ({id}.summary.json) holding the counts and skip reasons write_file puts in {id}.json.
+    If compression is set, the temporary file is compressed into {id}.jsonl.gz or {id}.jsonl.zst instead, as
+    checkpoints need to be able to cut it back.
+    """
+    def __init__(self, id, track_ids=False, compression=None):
+        """
+        :param id: institution id
+        :param track_ids: if set, the @ids of written records are kept in ids, for merging with a previous harvest
+        :param compression: None, gzip or zstd
+        """
+        self.id: str = id
+        self.compression: str = compression
+        self.path: str = ingest.get_compressed_path(f"{id}.jsonl", compression)
+        self.tmp_path: str = f"{id}.jsonl.tmp"
+        self.count: int = 0
+        self.ids: set = set() if track_ids else None
+        self.outf = None
+
+    def start(self, offset=None, count=0):
+        """
+        Opens the temporary file, either empty or, when a checkpointed harvest is resumed, cut back to the checkpoint's offset
+
+        :param offset: position in the temporary file up to which records were checkpointed
+        :param count: number of records written up to offset
+        :return: False if the harvest can't be resumed because the temporary file is gone or shorter than offset
+        """
+        if self.outf:
+            self.outf.close()
+        self.count = 0
+        self.ids = set() if self.ids is not None else None
+        if offset is None:
+            self.outf = open(self.tmp_path, "w")
+            return True
+        if not os.path.exists(self.tmp_path) or os.path.getsize(self.tmp_path) < offset:
+            return False
+        self.outf = open(self.tmp_path, "r+")
+        self.outf.truncate(offset)
+        self.outf.seek(offset)
+        self.count = count
+        if self.ids is not None:
+            with open(self.tmp_path, "r") as inf:
+                for line in inf:
+                    self.ids.add(json.loads(line)["sourceResource"]["@id"])
+        return True
+
+    def write(self, records):
+        for record in records:
+            if self.ids is not None:
+                self.ids.add(record["sourceResource"]["@id"])
+            self.outf.write(json.dumps(record))
+            self.outf.write("\n")
+            self.count += 1
+
+    def tell(self):
+        self.outf.flush()
+        return self.outf.tell()
+
+    def stop(self):
+        """
+        Closes the temporary file without moving it into place, so that an unfinished harvest can be resumed from it
+        """
+        self.outf.close()
+        self.outf = None
+
+    def close(self, name, skipped, skipped_records, retries=None):
+        """
+        Moves the records into place and writes the summary file
+
+        :param name: institution name
+        :param skipped: count of skipped records
+        :param skipped_records: skipped records by reason
+        :param retries: retry counts for the harvest
+        """
+        self.outf.close()
+        self.outf = None
+        if self.compression:
+            with open(self.tmp_path, "r") as inf, ingest.open_output(self.path, self.compression) as outf:
+                shutil.copyfileobj(inf, outf)
+            os.remove(self.tmp_path)
+        else:
+            os.replace(self.tmp_path, self.path)
+        ingest.remove_other_compressions(self.path)
+        with open(get_summary_path(self.path), "w") as outf:
+            json.dump({
+                "institution": name,
+                "count": self.count,
+                "skipped": skipped,
+                "retries": retries or {},
+                "skipped_errors": get_skipped_record_report(skipped_records)
+            }, outf, indent=4)
+
+        print(f"\n{self.count} records written to {self.path}")
+
+
+def load_previous_records(id):
+    """
+    Returns records from the output file of an institution's last harvest, if one exists
+
+    :param id: institution id
+    :return: list of records, or None if the institution hasn't been harvested before
+    """
+    path = find_data_file(id)
+    if not path:
+        return None
+    return read_data_file(path)['records']
+
+
+def merge_records(previous, updated, deleted):
+    """
+    Merges the records returned by an incremental harvest into the previous harvest's records.
+    Records are matched on their OAI header identifier, stored in sourceResource.@id.
+
+    :param previous: records from the previous harvest
+    :param updated: records returned by the incremental harvest
+    :param deleted: header identifiers the feed reported as deleted
+    :return: merged list of records
+    """
+    merged = {record["sourceResource"]["@id"]: record for record in previous}
+    for record in updated:
+        merged[record["sourceResource"]["@id"]] = record
+    for identifier in deleted:
+        merged.pop(identifier, None)
+    return list(merged.values())
+
+
+def merge_previous_records(writer, previous_path, deleted):
+    """
+    Streaming counterpart of merge_records: appends the records of the previous harvest that the incremental harvest
+    neither updated nor reported as deleted
+
+    :param writer: JSONLWriter the incremental harvest was written to, created with track_ids set
+    :param previous_path: path to the previous harvest's output file
+    :param deleted: header identifiers the feed reported as deleted
+    """
+    deleted = set(deleted)
+    writer.write(
+        record for record in iter_records(previous_path)
+        if record["sourceResource"]["@id"] not in writer.ids and record["sourceResource"]["@id"] not in deleted
+    )
+
+
+def get_harvest_state(id):
+    """
+    Returns the stored state of an institution's last successful harvest
+
+    :param id: institution id
+    :return: dict with the harvest's datestamp and the feed's granularity, or None
+    """
+    with harvest_state_lock:
+        if not os.path.exists(HARVEST_STATE_FILE):
+            return None
+        with open(HARVEST_STATE_FILE, "r") as inf:
+            return json.load(inf).get(id)
+
+
+def set_harvest_state(id, state):
+    """
+    Stores the state of an institution's successful harvest, to be used as the starting point of the next incremental harvest
+
+    :param id: institution id
+    :param state: dict with the harvest's datestamp and the feed's granularity
+    """
+    with harvest_state_lock:
+        data = {}
+        if os.path.exists(HARVEST_STATE_FILE):
+            with open(HARVEST_STATE_FILE, "r") as inf:
+                data = json.load(inf)
+        data[id] = state
+        with open(HARVEST_STATE_FILE, "w") as outf:
+            json.dump(data, outf, indent=4)
+
+
+def save_checkpoint(id, checkpoint):
+    """
+    Saves the progress of a harvest. The file is written to a temporary path first and then moved into place,
+    so a crash while saving never leaves a broken checkpoint behind.
+
+    :param id: institution id
+    :param checkpoint: dict with the next resumption token, page count and records mapped so far
+    """
+    os.makedirs(CHECKPOINTS_DIR, exist_ok=True)
+    path = f"{CHECKPOINTS_DIR}/{id}.json"
+    with open(f"{path}.tmp", "w") as outf:
+        json.dump(checkpoint, outf, default=str)
+    os.replace(f"{path}.tmp", path)
 
-    print(f"\n{len(metadata)} records written to {id}.json")
+
+def load_checkpoint(id):
+    path = f"{CHECKPOINTS_DIR}/{id}.json"
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as inf:
+        return json.load(inf)
+
+
+def clear_checkpoint(id):
+    path = f"{CHECKPOINTS_DIR}/{id}.json"
+    if os.path.exists(path):
+        os.remove(path)
 
 
 def generate_csvs():
@@ -128,9 +404,82 @@ def generate_csvs():
     """
     json_files = get_data_files()
     for file in json_files:
-        with open(file, "r") as inf:
-            data = json.load(inf)
-        write_csv(data['records'], file.replace(".json",".csv"))
+        data = read_data_file(file)
+        write_csv(data['records'], ingest.strip_compression(file).replace(".jsonl", ".csv").replace(".json",".csv"))
+
+
+class FieldPath:
+    """
+    Accessor for a field key, compiled once per key. Subfields are delimited by periods, e.g. "origininfo.dateissued".
+    """
+    __slots__ = ('field', 'keys')
+
+    def __init__(self, field):
+        self.field: str = field
+        self.keys: tuple = tuple(field.split('.'))
+
+    def get(self, metadata):
+        """
+        :param metadata: metadata object from OAI feed
+        :return: array of values for the field key, split on semicolons and with whitespace collapsed, or False if it isn't set
+        """
+        for key in self.keys:
+            if key not in metadata:
+                return False
+            metadata = metadata[key]
+        out = []
+
+        for m in metadata:
+            try:
+                out.extend(split_value(m))
+            except TypeError:
+                # Values that aren't strings can't be cached
+                out.extend(split_value.__wrapped__(m))
+        return out
+
+
+@lru_cache(maxsize=None)
+def get_field_path(field):
+    return FieldPath(field)
+
+
+@lru_cache(maxsize=VALUE_CACHE_SIZE)
+def split_value(value):
+    """
+    Splits a field value on semicolons and collapses whitespace in each part.
+    Rights statements, formats, languages and names repeat across a feed's records, so results are memoised.
+
+    :param value: string value of a metadata field
+    :return: tuple of parts
+    """
+    return tuple(" ".join(a.strip().split()) for a in value.split(";") if a)
+
+
+class FieldMemo:
+    """
+    Field values of a single record, each read from the metadata the first time it's asked for
+    """
+    __slots__ = ('metadata', 'values')
+
+    def __init__(self, metadata):
+        self.metadata: dict = metadata
+        self.values: dict = {}
+
+    def format(self, field, return_format="list"):
+        """
+        Same as format_metadata, for this record's metadata
+
+        :param field: a field key, possibly delimited by a period (for subfields)
+        :param return_format: "list" or "string"
+        :return: formatted value
+        """
+        if field in self.values:
+            value = self.values[field]
+        else:
+            value = self.values[field] = get_field_path(field).get(self.metadata)
+        formatted = format_value(field, value, return_format)
+        # The stored value is shared by every lookup of the field, so it's never handed out itself
+        return list(formatted) if formatted is value else formatted
 
 
 def get_metadata(field, metadata):
@@ -142,22 +491,64 @@ def get_metadata(field, metadata):
     :param metadata: metadata object from OAI feed.
     :return: array of values for given field key
     """
+    return get_field_path(field).get(metadata)
 
-    stack = field.split('.')
-    _metadata = metadata
-    for s in stack:
-        if s not in _metadata:
-            return False
-        _metadata = _metadata[s]
-    out = []
 
-    for m in _metadata:
-        out.extend([" ".join(a.strip().split()) for a in m.split(";") if a])
-    return out
+@lru_cache(maxsize=1)
+def get_language_index():
+    """
+    Builds a single lookup table from every form parse_language accepts to the language's ISO 639-3 code and name.
+    Names are matched on the capitalized input and codes on the lower-cased input, so only keys in those forms are kept.
+    Where a key appears more than once, the first code type in LANGUAGE_CODES wins, as it did when they were tried in turn.
+
+    :return: dict of name or code to (ISO 639-3 code, name)
+    """
+    index = {}
+    for name, lng in languages.name.items():
+        if name == name.capitalize():
+            index[name] = (lng.part3, lng.name)
+    for code in LANGUAGE_CODES:
+        for key, lng in getattr(languages, code).items():
+            if key == key.lower():
+                index.setdefault(key, (lng.part3, lng.name))
+    return index
 
 
 def parse_language(language_list):
-    outlist = []
+    """
+    Splits language values on delimiters and matches each one to an ISO 639 language by name or code
+
+    :param language_list: list of language values from a record
+    :return: list of dicts with the language's ISO 639-3 code and name
+    """
+    try:
+        matches = match_languages(tuple(language_list))
+    except TypeError:
+        # Values that aren't strings can't be cached
+        matches = match_languages.__wrapped__(tuple(language_list))
+    return [get_language_entry(part3, name) for part3, name in matches]
+
+
+@lru_cache(maxsize=None)
+def get_language_entry(part3, name):
+    """
+    Returns the sourceResource language entry for a language. Entries are shared by every record with the language,
+    so they're never changed once made.
+    """
+    return {"iso639_3": part3, "name": name}
+
+
+@lru_cache(maxsize=VALUE_CACHE_SIZE)
+def get_subject_entry(name):
+    """
+    Returns the sourceResource subject entry for a subject name. Like language entries, common subjects are shared
+    by the records that have them, so entries are never changed once made.
+    """
+    return {"name": name}
+
+
+@lru_cache(maxsize=LANGUAGE_CACHE_SIZE)
+def match_languages(language_list):
     delimiters = ['/', ',', ';']
     ll = []
     delimited = False
@@ -172,33 +563,14 @@ def parse_language(language_list):
         if not delimited:
             ll.append(language.strip())
         delimited = False
-    language_list = ll
-    for language in language_list:
-        language_found = False
-        codes = ['name', 'part3', 'part2b', 'part2t', 'part1']
-        for code in codes:
-            if code == 'name':
-                language = language.capitalize()
-            else:
-                language = language.lower()
-            try:
-                if code == 'name':
-                    lng = languages.get(name=language)
-                elif code == 'part3':
-                    lng = languages.get(part3=language)
-                elif code == 'part2b':
-                    lng = languages.get(part2b=language)
-                elif code == 'part2t':
-                    lng = languages.get(part2t=language)
-                elif code == 'part1':
-                    lng = languages.get(part1=language)
-                outlist.append({f"iso639_3": lng.part3, "name": lng.name})
-                language_found = True
-                break
-            except (KeyError, SyntaxError) as e:
-                continue
 
-    return outlist
+    index = get_language_index()
+    matches = []
+    for language in ll:
+        match = index.get(language.capitalize()) or index.get(language.lower())
+        if match:
+            matches.append(match)
+    return tuple(matches)
 
 
 def parse_date(datestr):
@@ -210,9 +582,8 @@ def parse_date(datestr):
     :return: a formatted date string
     """
 
-    try:
-        parsed = parser.parse(datestr)
-    except ValueError as e:
+    parsed = dates.parse_datetime(datestr)
+    if not parsed:
         print(f"{datestr} could not be parsed as a date. Skipping.")
         return False
 
@@ -301,15 +672,16 @@ def get_datadump(url):
     :param url: url to a JSON file
     :return: record metadata from file
     """
-    res = requests.get(url)
+    res = session.get(url)
     return res.json()['records']
 
 def crawled_recently(id, hours=24):
-    if not os.path.exists("files/institutions/{}.json".format(id, id)):
+    path = find_data_file(id, [DATA_DIR])
+    if not path:
         return False
     now = datetime.now()
     if now - timedelta(hours=hours) <= datetime.fromtimestamp(
-                os.path.getmtime("./files/institutions/{}.json".format(id, id))) <= now:
+                os.path.getmtime(path)) <= now:
         return True
     return False
 
@@ -335,8 +707,10 @@ def return_count():
 
 
 def format_metadata(field, metadata, return_format="list"):
-    value = get_metadata(field, metadata)
+    return format_value(field, get_metadata(field, metadata), return_format)
+
 
+def format_value(field, value, return_format="list"):
     # case 1: field doesn't exist, return either empty list or string
     if not value:
         if return_format == "string":
@@ -345,7 +719,7 @@ def format_metadata(field, metadata, return_format="list"):
 
     # case 2: subjects are always lists of dicts formatted a particular way
     if field == 'subject':
-        return [{"name": subj} for subj in value]
+        return [get_subject_entry(subj) for subj in value]
 
     # case 3: language
     if field == 'language':
@@ -365,26 +739,50 @@ def format_metadata(field, metadata, return_format="list"):
 
 
 def generate_cdm_thumbnail(url):
-    base, collection, record_id = parse_cdm_url(url)
-    thumbnail = "{}/utils/getthumbnail/collection/{}/id/{}".format(base, collection, record_id)
+    thumbnail = CDM_THUMBNAIL.format(*parse_cdm_url(url))
 
     return thumbnail
 
 def generate_cdm_iiif_manifest(url):
-    base, collection, record_id = parse_cdm_url(url)
-    iiif_manifest = f"{base}/iiif/info/{collection}/{record_id}/manifest.json"
+    iiif_manifest = CDM_IIIF_MANIFEST.format(*parse_cdm_url(url))
 
     return iiif_manifest
 
+def generate_cdm_urls(url):
+    """
+    Returns a CONTENTdm record's thumbnail and IIIF manifest URLs, parsing the record URL once
+
+    :param url: CONTENTdm record URL
+    :return: thumbnail and IIIF manifest URLs
+    """
+    parts = parse_cdm_url(url)
+    return CDM_THUMBNAIL.format(*parts), CDM_IIIF_MANIFEST.format(*parts)
+
 def parse_cdm_url(url):
+    prefix, _, record_id = url.rpartition("/")
     try:
-        collection = url.split("/")[url.split("/").index("collection") + 1]
+        base_url, collection = parse_cdm_prefix(prefix)
     except ValueError as e:
         print(url)
         raise
+    if collection is None:
+        # "collection" is the last part of the prefix, so the alias is the last part of the URL
+        collection = record_id
+
+    return base_url, collection, record_id
 
-    record_id = url.split("/")[-1]
-    o = urlparse(url)
+@lru_cache(maxsize=CDM_CACHE_SIZE)
+def parse_cdm_prefix(prefix):
+    """
+    Parses the part of a CONTENTdm record URL before the record id, which is the same for every record in a collection
+
+    :param prefix: record URL up to the last slash
+    :return: base URL and collection alias, or None for the alias if it comes after the prefix
+    """
+    parts = prefix.split("/")
+    index = parts.index("collection") + 1
+    collection = parts[index] if index < len(parts) else None
+    o = urlparse(prefix)
     base_url = "{}://{}".format(o.scheme, o.netloc)
 
-    return base_url, collection, record_id
+    return base_url, collection